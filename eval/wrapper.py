@@ -7,7 +7,6 @@ import os
 import subprocess
 import time
 
-from pyeda.boolalg import expr
 import click
 
 ################################################################################
@@ -57,6 +56,7 @@ class Lit(int):
         return map(Lit, [-var, var])
 
     def symbolizeLit(self):
+        from pyeda.boolalg import expr
         assert self, self
         var = expr.exprvar(self.PYEDA_VAR, abs(self))
         return var if self > 0 else ~var
@@ -87,6 +87,7 @@ class Clause(list):
             solver.add_clause(self)
 
     def symbolizeClause(self):
+        from pyeda.boolalg import expr
         assert self.xorFlag, self.xorFlag
         return expr.Xor(*map(Lit.symbolizeLit, self))
 
@@ -130,6 +131,7 @@ class CnfFormula:
         return solver.solve()[0]
 
     def getLitAndAuxVarsFromDisjunct(self, disjunct):
+        from pyeda.boolalg import expr
         if isinstance(disjunct, expr.Complement):
             assert len(disjunct.usupport) == 1, disjunct.usupport
             (var, auxVars) = self.getLitAndAuxVarsFromDisjunct(disjunct.top)
@@ -149,6 +151,7 @@ class CnfFormula:
             return (varIndex, auxVars)
 
     def getClauseAndAuxVarsFromConjunct(self, conjunct):
+        from pyeda.boolalg import expr
         if isinstance(conjunct, expr.OrOp):
             clause = []
             auxVars = set()
@@ -162,6 +165,7 @@ class CnfFormula:
             return ([lit], auxVars)
 
     def getClausesAndAuxVarsFromConjunction(self, conjunction):
+        from pyeda.boolalg import expr
         assert isinstance(conjunction, expr.AndOp), conjunction
         assert conjunction.is_cnf(), conjunction
         clauses = []
@@ -173,6 +177,7 @@ class CnfFormula:
         return (clauses, auxVars)
 
     def encodeTseitin(self):
+        from pyeda.boolalg import expr
         orClauses = []
         xorClauses = []
         for clause in self.clauses:
@@ -561,6 +566,8 @@ MAXHS = 'maxhs'
 UWR = 'uwr' # UWrMaxSat
 CMS = 'cms' # CryptoMiniSat
 
+TSEITIN_PROGS = {MAXHS, UWR} # without XOR clauses (DPMC executors read .xcnf files directly)
+
 def getAbsPath(*args): # relative to this file
     p = os.path.join(os.path.dirname(__file__), *args)
     p = os.path.realpath(p) # also resolves symbolic links
@@ -594,7 +601,7 @@ def getWrittenWcnfFilePath(cf, prog, temp, postProcess):
     startTime = time.time()
     cnfFormula = CnfFormula(cf)
     cnfFormula.readCnfFile()
-    if cf.endswith('.xcnf') and prog != GAUSS:
+    if cf.endswith('.xcnf') and prog in TSEITIN_PROGS:
         cnfFormula.encodeTseitin()
     wcnfFilePath = getTempFilePath(cf, temp, 'wcnf')
     WcnfFormula(cnfFormula).writeWcnfFile(wcnfFilePath, postProcess)
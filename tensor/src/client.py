@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Submit a job to a tensor executor server (see server.py) and print its output.
+
+Usage: client.py SOCKET [OPTIONS]
+
+The options are those of execute.py. The --formula file is sent to the server, and the
+join tree stream is read from the --join_tree file (default is stdin) and forwarded to
+the server as it arrives. Only the standard library is imported, so that startup is fast.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+    socket_path = argv[1]
+
+    # Extract the files that are read on this side of the socket
+    files = {"--formula": None, "--join_tree": "-"}
+    args = []
+    remaining = iter(argv[2:])
+    for arg in remaining:
+        name, equals, value = arg.partition("=")
+        if name in files:
+            files[name] = value if equals else next(remaining)
+        else:
+            args.append(arg)
+
+    header = {"args": args}
+    if files["--formula"] is not None:
+        with open(files["--formula"]) as formula:
+            header["formula"] = formula.read()
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    connection.sendall(json.dumps(header).encode() + b"\n")
+
+    def forward_join_trees():
+        if files["--join_tree"] == "-":
+            fd = sys.stdin.fileno()
+        else:
+            fd = os.open(files["--join_tree"], os.O_RDONLY)
+        try:
+            while True:
+                chunk = os.read(fd, 2 ** 16)
+                if len(chunk) == 0:
+                    break
+                connection.sendall(chunk)
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # The server has finished with the join tree stream
+
+    thread = threading.Thread(target=forward_join_trees)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        chunk = connection.recv(2 ** 16)
+        if len(chunk) == 0:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    connection.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,6 +2,9 @@
 
 
 import click
+import fractions
+import itertools
+import math
 import os
 import signal
 import sys
@@ -22,6 +25,12 @@ import util
     required=True,
     help="Formula to use.",
 )
+@click.option("--weight_matrix",
+    type=click.File(mode="r"),
+    default=None,
+    help="Weights to count with, one row per count (each row lists the positive and then "
+    "the negative literal weight of each variable; default is the weights of the formula).",
+)
 @click.option("--join_tree",
     type=click.File(mode="r"),
     default="-",
@@ -37,6 +46,11 @@ import util
     default=30,
     help="Join trees of larger tensor width are not used.",
 )
+@click.option("--max_sliced",
+    type=int,
+    default=0,
+    help="Number of variables that may be sliced to execute join trees of larger width.",
+)
 @click.option("--timeout",
     type=float,
     default=0.0,
@@ -50,50 +64,282 @@ import util
 @click.option("--thread_limit",
     type=int,
     default=1,
-    help="Number of threads to limit tensor manipulations.",
+    help="Number of threads to limit tensor manipulations (in total: each worker "
+    "uses its share).",
+)
+@click.option("--workers",
+    type=int,
+    default=1,
+    help="Number of threads to execute independent subtrees of the join tree "
+    "(or, with exact entries, to contract modulo different primes).",
+)
+@click.option("--memory_budget",
+    type=float,
+    default=0.0,
+    help="Memory that parallel execution may hold in results and shared tensors "
+    "(GB, 0 for no limit).",
+)
+@click.option("--spill_dir",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    default=None,
+    help="Scratch directory to spill waiting intermediate tensors to (default is no spilling).",
+)
+@click.option("--spill_budget",
+    type=float,
+    default=1.0,
+    help="Memory that waiting intermediate tensors and shared tensors may hold "
+    "before spilling (GB).",
+)
+@click.option("--buffer_budget",
+    type=float,
+    default=0.125,
+    help="Memory that the buffers of released tensors may hold until they are reused "
+    "by later tensors of the same size (GB, 0 disables reuse).",
 )
 @click.option("--entry_type",
     type=click.Choice(
-        ["uint", "int", "bigint", "float16", "float32", "float64"], case_sensitive=False
+        ["uint", "int", "bigint", "exact", "float16", "float32", "float64"],
+        case_sensitive=False,
     ),
     default="float64",
-    help="Data type to use for all tensor computations.",
+    help="Data type to use for all tensor computations "
+    "(exact computes the exact count through arithmetic modulo several primes).",
+)
+@click.option("--marginals",
+    is_flag=True,
+    help="Also compute the marginal probability of each variable, through a backward pass.",
+)
+@click.option("--hadamard",
+    is_flag=True,
+    help="Contract subtrees of only XOR clauses in the Hadamard (GF(2) Fourier) domain, "
+    "where that is cheaper.",
+)
+@click.option("--rescale",
+    is_flag=True,
+    help="Divide the result of each join tree node by its largest entry and track the "
+    "power of 10 separately, so that float32 and float16 counts do not underflow. "
+    "The count is also output as its log10.",
+)
+@click.option("--semiring",
+    type=util.TaggedChoice(tensor_network.ALL_SEMIRINGS, case_sensitive=False),
+    default="sum-product",
+    help="Semiring to contract in (max-product and log-max-sum solve weighted SAT, "
+    "also output a maximizing assignment as a v line, and count the natural logarithm "
+    "of the weight with log-max-sum).",
 )
 @click.option("--tensor_library",
     type=util.TaggedChoice(tensor_network.ALL_APIS, case_sensitive=False),
     default="numpy",
-    help="Tensor library to use.",
+    help="Tensor library to use. sparse stores the results of join tree nodes sparsely "
+    "when they are mostly zero; blocked splits large products between a pool of "
+    "--thread_limit threads.",
+)
+@click.option("--sparse_density",
+    type=float,
+    default=1 / 16,
+    help="With --tensor_library=sparse, results with at most this fraction of nonzero "
+    "entries are stored sparsely (and stored densely again above twice the fraction).",
+)
+@click.option("--sparse_min_rank",
+    type=int,
+    default=10,
+    help="With --tensor_library=sparse, results of lower rank are always stored "
+    "densely.",
+)
+@click.option("--min_block_work",
+    type=int,
+    default=2 ** 22,
+    help="With --tensor_library=blocked, products of fewer multiplications are not "
+    "split between threads.",
 )
 def run(
     formula,
+    weight_matrix,
     join_tree,
     output,
     max_width,
+    max_sliced,
     timeout,
     performance_factor,
     thread_limit,
+    workers,
+    memory_budget,
+    spill_dir,
+    spill_budget,
+    buffer_budget,
     entry_type,
+    marginals,
+    hadamard,
+    rescale,
+    semiring,
     tensor_library,
+    sparse_density,
+    sparse_min_rank,
+    min_block_work,
 ):
     sys.setrecursionlimit(100000)
-    tensor_library = tensor_library(entry_type, thread_limit=thread_limit)
+    execute_job(
+        formula,
+        weight_matrix,
+        join_tree,
+        output,
+        max_width,
+        max_sliced,
+        timeout,
+        performance_factor,
+        thread_limit,
+        workers,
+        memory_budget,
+        spill_dir,
+        spill_budget,
+        buffer_budget,
+        entry_type,
+        marginals,
+        hadamard,
+        rescale,
+        semiring,
+        tensor_library,
+        sparse_density,
+        sparse_min_rank,
+        min_block_work,
+    )
+
+
+def execute_job(
+    formula,
+    weight_matrix,
+    join_tree,
+    output,
+    max_width,
+    max_sliced,
+    timeout,
+    performance_factor,
+    thread_limit,
+    workers,
+    memory_budget,
+    spill_dir,
+    spill_budget,
+    buffer_budget,
+    entry_type,
+    marginals,
+    hadamard,
+    rescale,
+    semiring,
+    tensor_library,
+    sparse_density,
+    sparse_min_rank,
+    min_block_work,
+    timer_type=util.TimeoutTimer,
+    cache=None,
+    stop_join_tree=lambda: None,
+):
+    """
+    Count the formula with the best join tree of the stream, as specified by the options
+    of run, and output the results.
+
+    :param timer_type: The type of timer to use for the timeout
+    :param cache: A ResultCache of subtree results to share between jobs, if any
+    :param stop_join_tree: Function to end the join tree stream once a join tree is
+                           chosen, if the stream has no file descriptor
+    :return: None
+    """
+    if weight_matrix is not None and entry_type == "exact":
+        raise click.UsageError("A weight matrix cannot be used with exact entries")
+    if marginals and (weight_matrix is not None or entry_type == "exact"):
+        raise click.UsageError(
+            "Marginals cannot be used with a weight matrix or exact entries"
+        )
+    if semiring.maximizes and (
+        weight_matrix is not None or entry_type == "exact" or marginals
+    ):
+        raise click.UsageError(
+            "The {0} semiring cannot be used with a weight matrix, exact entries, "
+            "or marginals".format(semiring.name)
+        )
+    if semiring.name == "log-max-sum" and not entry_type.startswith("float"):
+        raise click.UsageError("The log-max-sum semiring requires float entries")
+    if hadamard and (
+        not entry_type.startswith("float")
+        or semiring.maximizes
+        or weight_matrix is not None
+        or marginals
+    ):
+        raise click.UsageError(
+            "The Hadamard domain requires float entries and the sum-product semiring, "
+            "and cannot be used with a weight matrix or marginals"
+        )
+    if rescale and (
+        not entry_type.startswith("float")
+        or semiring.maximizes
+        or weight_matrix is not None
+        or marginals
+    ):
+        raise click.UsageError(
+            "Rescaling requires float entries and the sum-product semiring, "
+            "and cannot be used with a weight matrix or marginals"
+        )
+    library_options = {}
+    if tensor_library is tensor_network.ALL_APIS["sparse"]:
+        library_options = {"max_density": sparse_density, "min_rank": sparse_min_rank}
+    elif tensor_library is tensor_network.ALL_APIS["blocked"]:
+        library_options = {"min_block_work": min_block_work}
+    tensor_library = tensor_library(
+        entry_type,
+        thread_limit=thread_limit,
+        semiring=semiring,
+        buffer_budget=buffer_budget * 2 ** 30,
+        **library_options
+    )
 
     stopwatch = util.Stopwatch()
-    with util.TimeoutTimer(timeout) as timer:
+    with timer_type(timeout) as timer:
         try:
             formula = util.Formula.parse_DIMACS(formula)
+            if weight_matrix is not None:
+                weight_matrix = formula.parse_weight_matrix(weight_matrix)
             stopwatch.record_interval("Parse Formula")
 
-            tree = get_join_tree(
-                formula, join_tree, timer, output, max_width, performance_factor
+            tree, sliced = get_join_tree(
+                formula,
+                join_tree,
+                timer,
+                output,
+                max_width,
+                performance_factor,
+                max_sliced=max_sliced,
+                entry_size=tensor_library.get_entry_size(),
+                stop_stream=stop_join_tree,
             )
             if tree is not None:
                 timer.reset_timeout(timeout)
                 stopwatch.record_interval("Parse Join Tree")
 
-                count = execute_join_tree(formula, tree, tensor_library, output)
+                # The workers share the threads of tensor manipulations
+                with tensor_library.limit_threads(workers):
+                    count = execute_join_tree(
+                        formula,
+                        tree,
+                        tensor_library,
+                        output,
+                        workers=workers,
+                        memory_budget=memory_budget,
+                        sliced=sliced,
+                        spill_dir=spill_dir,
+                        spill_budget=spill_budget,
+                        exact=entry_type == "exact",
+                        weight_matrix=weight_matrix,
+                        marginals=marginals,
+                        cache=cache,
+                        hadamard=hadamard,
+                        rescale=rescale,
+                        check_timeout=timer.check,
+                    )
                 if count is not None:
-                    output.output_pair("Count", count)
+                    if weight_matrix is None:
+                        output.output_pair("Count", count)
+                    else:
+                        for row_count in count:
+                            output.output_pair("Count", row_count)
                     stopwatch.record_interval("Execution")
             stopwatch.record_total("Total")
         except TimeoutError:
@@ -109,35 +355,37 @@ def run(
 
 
 def get_join_tree(
-    formula, join_tree_stream, timer, output, max_width, performance_factor
+    formula,
+    join_tree_stream,
+    timer,
+    output,
+    max_width,
+    performance_factor,
+    max_sliced=0,
+    entry_size=8,
+    stop_stream=lambda: None,
 ):
     best_join_tree = None
     best_time = None
     best_width = None
-    pid = None
     timed_out = False
 
+    pipeline = jt.JoinTreePipeline(
+        join_tree_stream,
+        formula,
+        log=lambda message: util.log(message, flush=True),
+        check_timeout=timer.check,
+        stop_stream=stop_stream,
+    )
+    timer.add_wakeup(pipeline.wake)
     try:
-        while True:
-            next_join_tree, gen_time, new_pid = jt.JoinTree.parse_jt(
-                join_tree_stream, log=util.log
-            )
-            if next_join_tree is None:
-                break
-            width = next_join_tree.tensor_width(formula)
-            util.log("Parsed join tree with tensor width " + str(width), flush=True)
-
-            if new_pid is not None:
-                pid = new_pid
-
-            if best_width is None or width < best_width:
-                best_join_tree = next_join_tree
-                best_time = gen_time
-                best_width = width
-
-                if width <= max_width:
-                    flops = next_join_tree.tensor_flops(formula)
-                    timer.recap_timeout(flops * performance_factor)
+        for next_join_tree, stats, gen_time in pipeline:
+            best_join_tree = next_join_tree
+            best_time = gen_time
+            best_width = stats.tensor_width
+
+            if best_width <= max_width:
+                timer.recap_timeout(stats.flops * performance_factor)
     except TimeoutError:
         timed_out = True
     except:
@@ -146,11 +394,13 @@ def get_join_tree(
         output.output_pair("Error", "tree unknown error")
 
     # Kill the planning process when done
+    pid = pipeline.pid
     if pid is not None:
         try:
             os.kill(pid, signal.SIGKILL)
         except ProcessLookupError:
             pass
+    pipeline.stop()
 
     if best_join_tree is None:
         if timed_out:
@@ -159,59 +409,781 @@ def get_join_tree(
         else:
             util.log("Unable to parse join tree", flush=True)
             output.output_pair("Error", "tree parse")
+        return None, None
+
+    sliced = []
+    if best_width > max_width:
+        sliced, sliced_width = choose_sliced_variables(
+            formula, best_join_tree, max_width, max_sliced
+        )
+        if sliced is None:
+            util.log("Join tree has width higher than " + str(max_width), flush=True)
+            output.output_pair("Error", "tree large")
+            return None, None
+
+        util.log(
+            "Sliced {0} variables for tensor width {1}".format(
+                len(sliced), sliced_width
+            ),
+            flush=True,
+        )
+        output.output_pair("Sliced Variables", " ".join(map(str, sliced)))
+        output.output_pair(
+            "Slicing Memory Saved",
+            entry_size * (2 ** best_width - 2 ** sliced_width),
+        )
+
+    if best_time is not None:
+        output.output_pair("Join Tree Time", best_time)
+    return best_join_tree, sliced
+
+
+def choose_sliced_variables(formula, join_tree, max_width, max_sliced):
+    """
+    Greedily choose variables to slice until the tensor width is at most max_width.
+
+    At each step, the variable that most reduces the tensor width (and then the flops)
+    is sliced, among the variables of the largest results and of the longest clauses.
+    Inner variables of a projected formula are never sliced.
+
+    :return: The list of variables to slice and the resulting tensor width,
+             or None if more than max_sliced variables are required.
+    """
+    sliced = []
+    width = join_tree.tensor_width(formula)
+    while width > max_width:
+        if len(sliced) >= max_sliced:
+            return None, width
+
+        # Try the variables of the largest results and of the clauses that are too long
+        node_variables = join_tree.node_variables(formula, sliced=set(sliced))
+        largest = max(len(variables) for variables in node_variables.values())
+        candidates = set()
+        for variables in node_variables.values():
+            if len(variables) >= largest - 1:
+                candidates.update(variables)
+        for clause in formula.clauses:
+            variables = {abs(lit) for lit in clause} - set(sliced)
+            if len(variables) > max_width:
+                candidates.update(variables)
+        # The counts of slices can only be added up for outer variables
+        candidates = {var for var in candidates if not formula.is_inner(var)}
+        if len(candidates) == 0:
+            return None, width
+
+        best = None
+        for var in sorted(candidates):
+            stats = join_tree.analyze(formula, sliced=set(sliced) | {var})
+            score = (stats.tensor_width, stats.flops)
+            if best is None or score < best[0]:
+                best = (score, var)
+        sliced.append(best[1])
+        width = best[0][0]
+    return sliced, width
+
+
+def execute_join_tree(
+    formula,
+    join_tree,
+    tensor_library,
+    output,
+    workers=1,
+    memory_budget=0.0,
+    sliced=(),
+    spill_dir=None,
+    spill_budget=1.0,
+    exact=False,
+    weight_matrix=None,
+    marginals=False,
+    cache=None,
+    hadamard=False,
+    rescale=False,
+    check_timeout=lambda: None,
+):
+    spillers = []
+    cache_hits = []
+    semiring = tensor_library.semiring
+    if semiring.maximizes and formula.outer_variables is not None:
+        util.log("Projected formulas can only be counted by sum-product", flush=True)
+        output.output_pair("Error", "execution projected semiring")
         return None
-    elif best_width > max_width:
-        util.log("Join tree has width higher than " + str(max_width), flush=True)
-        output.output_pair("Error", "tree large")
+    argmax = {} if semiring.maximizes else None
+    batch_size = 1 if weight_matrix is None else weight_matrix.shape[-1]
+
+    def contract(lib, literal_weight, workers, gradients=None, argmax=None):
+        spiller = None
+        if spill_dir is not None:
+            spiller = tensor_network.Spiller(lib, spill_dir, spill_budget * 2 ** 30)
+            spillers.append(spiller)
+        return contract_join_tree(
+            formula,
+            join_tree,
+            lib,
+            literal_weight,
+            workers=workers,
+            memory_budget=memory_budget,
+            sliced=sliced,
+            at_waiting=spiller,
+            batch_size=batch_size,
+            gradients=gradients,
+            argmax=argmax,
+            cache=cache,
+            cache_hits=cache_hits,
+            hadamard=hadamard,
+            rescale=rescale,
+            check_timeout=check_timeout,
+        )
+
+    def batch_literal_weight(lit):
+        if abs(lit) >= len(weight_matrix):
+            return 1.0  # The variable does not appear in the formula
+        return weight_matrix[abs(lit), 1 if lit > 0 else 0]
+
+    try:
+        if exact:
+            count = count_exact(formula, tensor_library, contract, workers)
+        elif weight_matrix is not None:
+            count = contract(tensor_library, batch_literal_weight, workers)
+        elif marginals:
+            gradients = {}
+            count = contract(tensor_library, formula.literal_weight, workers, gradients)
+            for var in sorted({abs(lit) for lit in gradients}):
+                # The share of the count from assignments where the variable is true
+                output.output_pair(
+                    "Marginal " + str(var),
+                    formula.literal_weight(var) * gradients.get(var, 0) / count,
+                )
+        elif argmax is not None:
+            count = contract(
+                tensor_library, formula.literal_weight, workers, argmax=argmax
+            )
+            if count > semiring.zero:
+                num_variables = max(
+                    [abs(lit) for clause in formula.clauses for lit in clause],
+                    default=0,
+                )
+                output.output_pair(
+                    "v",
+                    "".join(
+                        str(argmax.get(var, 0)) for var in range(1, num_variables + 1)
+                    ),
+                )
+        else:
+            count = contract(tensor_library, formula.literal_weight, workers)
+            if rescale:
+                mantissa, exponent = count
+                count = mantissa
+                if mantissa == 0:
+                    output.output_pair("Log10 Count", -math.inf)
+                elif math.isfinite(mantissa):
+                    output.output_pair(
+                        "Log10 Count", math.log10(abs(mantissa)) + exponent
+                    )
+                    count = "{0}e{1:+d}".format(mantissa, exponent)
+
+        if spill_dir is not None:
+            output.output_pair(
+                "Spilled Bytes", sum(spiller.spilled_bytes for spiller in spillers)
+            )
+        if cache is not None and not marginals:
+            output.output_pair("Cache Hits", sum(cache_hits))
+        output.output_pair(
+            "Transposed Bytes", tensor_library.transpose_counts["copied"]
+        )
+        output.output_pair(
+            "Saved Transpose Bytes", tensor_library.transpose_counts["saved"]
+        )
+        output.output_pair(
+            "Allocated Buffers", tensor_library.buffer_counts["allocated"]
+        )
+        output.output_pair("Reused Buffers", tensor_library.buffer_counts["reused"])
+        output.output_pair(
+            "Reused Buffer Bytes", tensor_library.buffer_counts["reused_bytes"]
+        )
+        return count
+    except TimeoutError:
+        util.log("Execution timed out", flush=True)
+        output.output_pair("Error", "execution timeout")
         return None
-    else:
-        if best_time is not None:
-            output.output_pair("Join Tree Time", best_time)
-        return best_join_tree
+    except:
+        util.log("Error during execution", flush=True)
+        util.log(traceback.format_exc())
+        output.output_pair("Error", "execution unknown error")
+        return None
+
+
+def count_exact(formula, tensor_library, contract, workers):
+    """
+    Compute the exact weighted count of the formula.
 
+    The weights of each variable are scaled to integers by their least common
+    denominator, as given in the formula (see Formula.exact_literal_weight). The join
+    tree is then contracted with int64 arithmetic modulo enough word-size primes to bound
+    the scaled count, using one thread per prime, and the count is reconstructed by the
+    Chinese remainder theorem.
+
+    :param formula: The formula to count
+    :param tensor_library: The tensor library to derive the modular tensor libraries from
+    :param contract: Function to contract the join tree, given a tensor library,
+                     the weight of each literal, and the number of workers
+    :param workers: The number of primes to contract at once
+    :return: The exact count, as a Fraction
+    """
+    variables = {
+        abs(lit)
+        for clause in formula.clauses
+        for lit in clause
+        if not formula.is_inner(abs(lit))
+    }
+    scaled = {
+        var: tensor_network.scale_weights(
+            formula.exact_literal_weight(-var), formula.exact_literal_weight(var)
+        )
+        for var in variables
+    }
+
+    # The scaled count is at most the sum of all scaled assignment weights
+    bound = 1
+    denominator = 1
+    for neg_weight, pos_weight, var_denominator in scaled.values():
+        bound *= abs(neg_weight) + abs(pos_weight)
+        denominator *= var_denominator
+    moduli = tensor_network.choose_moduli(bound)
+
+    def contract_modulo(modulus):
+        def literal_weight(lit):
+            neg_weight, pos_weight, _ = scaled.get(abs(lit), (1, 1, 0))
+            return (pos_weight if lit > 0 else neg_weight) % modulus
+
+        return contract(tensor_library.with_modulus(modulus), literal_weight, 1)
+
+    residues = util.map_parallel(contract_modulo, moduli, workers)
+    return fractions.Fraction(tensor_network.reconstruct(residues, moduli), denominator)
+
+
+def contract_join_tree(
+    formula,
+    join_tree,
+    tensor_library,
+    literal_weight,
+    workers=1,
+    memory_budget=0.0,
+    sliced=(),
+    at_waiting=None,
+    batch_size=1,
+    gradients=None,
+    argmax=None,
+    cache=None,
+    cache_hits=None,
+    hadamard=False,
+    rescale=False,
+    check_timeout=lambda: None,
+):
+    """
+    Contract the tensor network of the formula along the join tree, in the semiring of
+    the tensor library.
+
+    If the formula is projected, the join tree must be graded. Inner variables are then
+    projected existentially (by a sum whose nonzero entries are replaced by 1), and outer
+    variables are projected by a weighted sum.
+
+    :param formula: The formula whose clauses are the leaves of the join tree
+    :param join_tree: The join tree to contract
+    :param tensor_library: The underlying tensor library
+    :param literal_weight: Function that returns the weight of each DIMACS literal
+    :param workers: Number of threads to execute independent subtrees of the join tree
+    :param memory_budget: Memory that parallel execution may hold in results (GB)
+    :param sliced: Variables to slice, whose slices are contracted one after another
+    :param at_waiting: Function to call with the results that wait on their parent
+    :param batch_size: The number of counts computed at once, if the weights are batched
+    :param gradients: If a dictionary, the derivative of the count with respect to the
+                      weight of each literal is added to it by a backward pass. The inputs
+                      of every join are then kept until the backward pass.
+    :param argmax: If a dictionary, then (in a maximizing semiring) the value of each
+                   variable in an assignment of maximum weight is stored in it by a
+                   traceback. The inputs of every join are then kept until the traceback.
+    :param cache: A ResultCache to reuse the results of subtrees from earlier
+                  contractions, and to keep the results of this contraction.
+                  Not used with gradients or argmax.
+    :param cache_hits: If a list, the number of results found in the cache for each
+                       slice is appended to it
+    :param hadamard: If true, subtrees of XOR clauses are contracted in the Hadamard
+                     domain where that is cheaper (see choose_hadamard_nodes). Requires
+                     float entries and the sum-product semiring, and is not used with
+                     gradients.
+    :param rescale: If true, the result of each node is rescaled (see Tensor.rescale).
+                    Requires the sum-product semiring, and is not used with gradients
+                    or batches.
+    :param check_timeout: Function to call before each node is contracted (on any
+                          thread), which raises a TimeoutError once the timeout passes
+    :return: The weighted count, or an array of the weighted counts of the batch, or
+             (if rescale) the weighted count in scientific notation (see to_scientific)
+    """
+    semiring = tensor_library.semiring
+    assignment = {}  # The values of the sliced variables in the current slice
+    records = {}  # For the backward pass, the record of each result by its id
+    keep_records = gradients is not None or argmax is not None
+    if keep_records:
+        cache = None  # The backward pass needs the record of every join
+
+    def leaf_key(node_id):
+        clause = formula.clause(node_id - 1)
+        return tensor_network.ResultCache.key(
+            tensor_library.fingerprint(),
+            "xor" if formula.is_xor(node_id - 1) else "or",
+            clause,
+            [assignment.get(abs(lit)) for lit in clause],
+        )
+
+    def internal_node_key(child_keys, projected_vars):
+        parts = list(child_keys)
+        for var in projected_vars:
+            if var in assignment:
+                continue
+            elif formula.is_inner(var):
+                parts += [var, "exists"]
+            else:
+                parts += [var, literal_weight(-var), literal_weight(var)]
+        return tensor_network.ResultCache.key(*parts)
 
-def execute_join_tree(formula, join_tree, tensor_library, output):
     def at_leaf(node_id):
-        return tensor_network.Tensor.from_clause(
+        check_timeout()
+        if formula.is_xor(node_id - 1):
+            return tensor_network.Tensor.from_xor_clause(
+                tensor_library, formula.clause(node_id - 1), assignment
+            )
+        result = tensor_network.Tensor.from_clause(
             tensor_library, formula.clause(node_id - 1)
         )
+        result.condition(assignment)
+        return result
 
     def at_internal_node(children, projected_vars):
+        check_timeout()
         projected_weights = {
-            var: (formula.literal_weight(-var), formula.literal_weight(var))
+            var: (1, 1)
+            if formula.is_inner(var)
+            else (
+                semiring.weight(literal_weight(-var)),
+                semiring.weight(literal_weight(var)),
+            )
             for var in projected_vars
+            if var not in assignment
         }
+        exists = any(formula.is_inner(var) for var in projected_vars)
 
         # Handle join tree internal nodes that have no children
         children = [c for c in children if c is not None]
         if len(children) == 0:
             return None
 
-        result = children[0]
-        if len(children) == 1:
-            # Nothing to join with, just do the projection
-            result.project_out(tensor_library, projected_weights)
+        if not keep_records or exists:
+            # No weight of an outer variable is below a node that projects inner
+            # variables, so the backward pass stops there
+            if keep_records:
+                for child in children:
+                    records.pop(id(child), None)
+            result = join_tensors(tensor_library, children, projected_weights)
+            if exists:
+                result.threshold(tensor_library)
+            if rescale:
+                result.rescale(tensor_library)
+            result.compact(tensor_library)
             return result
 
-        # Perform all joins, including the projection for the last
-        for other in children[1:-1]:
-            result.join_with(tensor_library, other, [])
-        result.join_with(tensor_library, children[-1], projected_weights)
+        # Keep the inputs of this node (read-only, since joins may reuse their entries)
+        child_records = [records.pop(id(child), None) for child in children]
+        inputs = [child.share(tensor_library) for child in children]
+        result = join_tensors(tensor_library, children, projected_weights)
+        result.compact(tensor_library)
+        records[id(result)] = (inputs, projected_weights, child_records)
+        return result
+
+    if workers > 1:
+        entry_size = tensor_library.get_entry_size()
+        result_memory = {
+            node: entry_size * batch_size * 2 ** len(variables)
+            for node, variables in join_tree.node_variables(
+                formula, sliced=set(sliced)
+            ).items()
+        }
+
+    hadamard_nodes = {}
+    hadamard_contracted = 0
+    if hadamard:
+        hadamard_nodes = choose_hadamard_nodes(formula, join_tree, sliced=sliced)
+
+    def contract_hadamard(node):
+        clause_ids, projected, variables = hadamard_nodes[node]
+        return tensor_network.contract_xor_clauses(
+            tensor_library,
+            [formula.clause(clause_id) for clause_id in clause_ids],
+            assignment,
+            {var: (literal_weight(-var), literal_weight(var)) for var in projected},
+            sorted(variables),
+        )
+
+    # Sum the weighted counts of all slices (in the semiring)
+    count = (0.0, 0) if rescale else semiring.zero
+    for values in itertools.product([0, 1], repeat=len(sliced)):
+        assignment.clear()
+        assignment.update(zip(sliced, values))
+        weight = semiring.one
+        for var, value in assignment.items():
+            weight = tensor_library.reduce(
+                semiring.multiply(
+                    weight, semiring.weight(literal_weight(var if value == 1 else -var))
+                )
+            )
+
+        memo = None
+        if cache is not None:
+            memo = cache.memo(
+                tensor_library, join_tree.fold(internal_node_key, leaf_key)
+            )
+        known = memo
+        if len(hadamard_nodes) > 0:
+            known = _HadamardMemo(hadamard_nodes, contract_hadamard, memo)
+
+        if workers > 1:
+            result = join_tree.visit_parallel(
+                at_internal_node,
+                at_leaf,
+                workers,
+                result_memory=result_memory.get,
+                memory_budget=memory_budget * 2 ** 30,
+                other_memory=lambda: tensor_library.held_bytes,
+                at_waiting=at_waiting,
+                memo=known,
+            )
+        else:
+            result = join_tree.visit(
+                at_internal_node, at_leaf, at_waiting=at_waiting, memo=known
+            )
+        if memo is not None and cache_hits is not None:
+            cache_hits.append(memo.hits)
+        if known is not memo:
+            hadamard_contracted += known.contracted
+        result.materialize(tensor_library)
+        if rescale:
+            count = tensor_network.add_scientific(
+                count,
+                tensor_network.to_scientific(
+                    weight * float(result.base[tuple()]), result.log_scale
+                ),
+            )
+            continue
+        root = result.base[tuple()]
+        if result.log_scale != 0:
+            # The result of a subtree was rescaled by an earlier contraction (see cache)
+            root = root * 10 ** result.log_scale
+        slice_count = tensor_library.reduce(semiring.multiply(weight, root))
+        record = records.pop(id(result), None)
+        if argmax is not None and slice_count > count:
+            argmax.clear()
+            argmax.update(assignment)
+            if record is not None:
+                trace_back(tensor_library, record, argmax, check_timeout)
+        count = tensor_library.reduce(semiring.add(tensor_library, count, slice_count))
+
+        if gradients is not None:
+            adjoint = tensor_network.Tensor(
+                tensor_library.create_tensor([], weight), []
+            )
+            if record is not None:
+                backpropagate(
+                    tensor_library, record, adjoint, gradients, check_timeout
+                )
+
+            # The weights of sliced variables multiply the result of each slice
+            for var, value in assignment.items():
+                others = 1
+                for other, other_value in assignment.items():
+                    if other != var:
+                        others *= literal_weight(other if other_value == 1 else -other)
+                lit = var if value == 1 else -var
+                gradients[lit] = gradients.get(lit, 0) + others * result.base[tuple()]
+    if hadamard_contracted > 0:
+        util.log(
+            "Contracted {0} subtrees of XOR clauses in the Hadamard domain".format(
+                hadamard_contracted
+            ),
+            flush=True,
+        )
+    return count
+
+
+def choose_hadamard_nodes(formula, join_tree, sliced=()):
+    """
+    Choose the internal nodes of the join tree whose subtree is cheaper to contract in
+    the Hadamard domain: every leaf is an XOR clause, no inner variable is projected,
+    and 2^(number of clauses) terms are fewer than the entries of the joins of the
+    subtree. Only the highest such nodes are used by the contraction.
+
+    :param formula: The formula whose clauses are the leaves of the join tree
+    :param join_tree: The join tree to contract
+    :param sliced: Variables that are fixed to a value, and so do not appear in tensors
+    :return: A dictionary mapping each chosen node to the ids of the clauses at its
+             leaves, the variables projected within its subtree, and the variables
+             of its result
+    """
+    sliced = set(sliced)
+
+    # At each node, the clauses, projected variables, and entries of the joins of its
+    # subtree (or None if it is not a subtree of XOR clauses), and its variables
+    def at_leaf(node_id):
+        variables = {abs(lit) for lit in formula.clause(node_id - 1)} - sliced
+        if not formula.is_xor(node_id - 1):
+            return None, variables
+        return ([node_id - 1], set(), 0), variables
+
+    def at_internal_node(children, projected_vars):
+        joined = set().union(*(variables for _, variables in children))
+        variables = joined - set(projected_vars)
+        if any(subtree is None for subtree, _ in children) or any(
+            formula.is_inner(var) for var in projected_vars
+        ):
+            return None, variables
+        clause_ids = [i for (ids, _, _), _ in children for i in ids]
+        projected = set(var for var in projected_vars if var in joined)
+        projected.update(*(subtree[1] for subtree, _ in children))
+        entries = 2 ** len(joined) + sum(subtree[2] for subtree, _ in children)
+        return (clause_ids, projected, entries), variables
+
+    result = {}
+    for node, (subtree, variables) in join_tree.fold(at_internal_node, at_leaf).items():
+        if subtree is None or subtree[2] == 0:
+            continue  # Not a subtree of XOR clauses, or a leaf
+        clause_ids, projected, entries = subtree
+        terms = 2 ** len(clause_ids) * (len(projected) + len(variables) + 1)
+        if len(clause_ids) <= 24 and terms < entries:
+            result[node] = (clause_ids, projected, variables)
+    return result
+
 
+class _HadamardMemo:
+    """
+    A memo for JoinTree.visit that contracts the chosen subtrees in the Hadamard domain,
+    and otherwise defers to another memo (e.g. of a result cache), if any.
+    """
+
+    def __init__(self, nodes, contract, memo=None):
+        """
+        :param nodes: The chosen nodes
+        :param contract: Function to contract the subtree of a chosen node
+        :param memo: The memo to defer to
+        """
+        self._nodes = nodes
+        self._contract = contract
+        self._memo = memo
+        self.contracted = 0
+
+    def get(self, node):
+        result = None if self._memo is None else self._memo.get(node)
+        if result is None and node in self._nodes:
+            result = self._contract(node)
+            self.contracted += 1
+            self.put(node, result)
         return result
 
-    try:
-        count = join_tree.visit(at_internal_node, at_leaf)
-        return count.base[tuple()]
-    except TimeoutError:
-        util.log("Execution timed out", flush=True)
-        output.output_pair("Error", "execution timeout")
-        return None
-    except:
-        util.log("Error during execution", flush=True)
-        util.log(traceback.format_exc())
-        output.output_pair("Error", "execution unknown error")
-        return None
+    def put(self, node, result):
+        if self._memo is not None:
+            self._memo.put(node, result)
+
+
+def join_tensors(tensor_library, tensors, projected_weights):
+    """
+    Join the provided tensors and project out the provided variables,
+    in the order chosen by plan_joins.
+
+    :param tensor_library: The underlying tensor library
+    :param tensors: The list of tensors to join (which are modified during execution)
+    :param projected_weights: The variables to project out, mapped to their weights
+    :return: The resulting tensor
+    """
+    initial, steps = tensor_network.plan_joins(
+        [set(tensor.variables) for tensor in tensors], projected_weights
+    )
+
+    # Project variables that appear in only one tensor before any join
+    for tensor, projected in zip(tensors, initial):
+        tensor.project_out(
+            tensor_library, {var: projected_weights[var] for var in projected}
+        )
+
+    # Perform the joins in the planned order, discarding operands once joined
+    tensors = list(tensors)
+    for left, right, projected in steps:
+        result = tensors[left]
+        result.join_with(
+            tensor_library,
+            tensors[right],
+            {var: projected_weights[var] for var in projected},
+        )
+        tensors[left] = None
+        tensors[right] = None
+        tensors.append(result)
+
+    return tensors[-1]
+
+
+def backpropagate(
+    tensor_library, record, adjoint, gradients, check_timeout=lambda: None
+):
+    """
+    Compute the derivatives of the count with respect to the weights of the variables
+    projected within a subtree of the join tree, through a backward pass from its root.
+
+    At each node, the adjoint of a child (i.e., the derivative of the count with respect
+    to each entry of the child) is the join of the adjoint of the node with all other
+    children, where the variables projected at the node are weighted as in the forward
+    pass and all other variables missing from the child are summed. These joins share
+    the partial products of the adjoint with each prefix of the children, and of each
+    suffix of the children, so that each node costs a number of joins linear in its
+    number of children.
+
+    :param tensor_library: The underlying tensor library
+    :param record: The inputs of the root of the subtree, the weights of the variables
+                   projected there, and the records of its children (None for leaves)
+    :param adjoint: The derivative of the count with respect to each entry of the result
+                    of the root of the subtree
+    :param gradients: A dictionary to add the derivative for each literal weight to
+    :param check_timeout: Function to call before each node, which raises a TimeoutError
+                          once the timeout passes
+    :return: None
+    """
+
+    def join_summing(tensors, kept, projected_weights):
+        # Join the tensors, summing all variables not kept (weighted if projected here)
+        return join_tensors(
+            tensor_library,
+            [tensor.share(tensor_library) for tensor in tensors if tensor is not None],
+            {
+                var: projected_weights.get(var, (1, 1))
+                for tensor in tensors
+                if tensor is not None
+                for var in tensor.variables
+                if var not in kept
+            },
+        ).share(tensor_library)
+
+    processed = [(record, adjoint)]
+    while len(processed) > 0:
+        check_timeout()
+        (inputs, projected_weights, child_records), adjoint = processed.pop()
+        differentiated = set()
+
+        # The variables of inputs[i:], and of the adjoint and inputs[:i], for each i
+        later = [set() for _ in range(len(inputs) + 1)]
+        for i in reversed(range(len(inputs))):
+            later[i] = later[i + 1] | set(inputs[i].variables)
+        earlier = [set(adjoint.variables)]
+        for child in inputs:
+            earlier.append(earlier[-1] | set(child.variables))
+
+        # prefixes[i] is the join of the adjoint with inputs[:i], and suffixes[i] is the
+        # join of inputs[i:], each summing the variables that no other input shares
+        prefixes = [adjoint.share(tensor_library)]
+        for i in range(len(inputs) - 1):
+            prefixes.append(
+                join_summing([prefixes[i], inputs[i]], later[i + 1], projected_weights)
+            )
+        suffixes = [None for _ in range(len(inputs) + 1)]
+        for i in reversed(range(1, len(inputs))):
+            suffixes[i] = join_summing(
+                [inputs[i], suffixes[i + 1]], earlier[i], projected_weights
+            )
+
+        for i, child in enumerate(inputs):
+            # The adjoint of a leaf is only needed for weights not yet differentiated
+            local = [var for var in child.variables if var in projected_weights]
+            if child_records[i] is None and differentiated.issuperset(local):
+                continue
+            partial = join_summing(
+                [prefixes[i], suffixes[i + 1]], set(child.variables), projected_weights
+            )
+
+            # Differentiate the weights of the variables of the child projected here,
+            # from the product of the partial product and the child
+            local_new = [var for var in local if var not in differentiated]
+            if len(local_new) > 0:
+                joint = partial.share(tensor_library)
+                joint.join_with(tensor_library, child.share(tensor_library), {})
+                for var in local_new:
+                    differentiated.add(var)
+                    derivative = joint.share(tensor_library)
+                    derivative.project_out(
+                        tensor_library,
+                        {
+                            other: projected_weights.get(other, (1, 1))
+                            for other in joint.variables
+                            if other != var
+                        },
+                    )
+                    derivative.materialize(tensor_library)
+                    gradients[-var] = gradients.get(-var, 0) + derivative.base[0]
+                    gradients[var] = gradients.get(var, 0) + derivative.base[1]
+
+            if child_records[i] is not None:
+                # Include the weights of the variables of the child projected here
+                child_adjoint = partial.share(tensor_library)
+                for var in local:
+                    child_adjoint.join_with(
+                        tensor_library,
+                        tensor_network.Tensor(
+                            tensor_library.stack(projected_weights[var]), [var]
+                        ),
+                        {},
+                    )
+                processed.append((child_records[i], child_adjoint))
+
+
+def trace_back(tensor_library, record, assignment, check_timeout=lambda: None):
+    """
+    Extend an assignment of the variables that remain at the root of a subtree of the
+    join tree to an assignment of maximum weight, by a traceback from its root.
+
+    At each node, the variables projected there are set to a maximizing assignment of
+    the product of the inputs of the node (with all other variables already assigned)
+    and of their weights.
+
+    :param tensor_library: The underlying tensor library (in a maximizing semiring)
+    :param record: The inputs of the root of the subtree, the weights of the variables
+                   projected there, and the records of its children (None for leaves)
+    :param assignment: A dictionary of the value of each assigned variable, which is
+                       extended with the variables projected within the subtree
+    :param check_timeout: Function to call before each node, which raises a TimeoutError
+                          once the timeout passes
+    :return: None
+    """
+    processed = [record]
+    while len(processed) > 0:
+        check_timeout()
+        inputs, projected_weights, child_records = processed.pop()
+        processed.extend(record for record in child_records if record is not None)
+
+        chosen = [var for var in projected_weights if var not in assignment]
+        if len(chosen) == 0:
+            continue
+        product = tensor_network.Tensor(
+            tensor_library.stack(projected_weights[chosen[0]]), [chosen[0]]
+        )
+        factors = [
+            tensor_network.Tensor(tensor_library.stack(projected_weights[var]), [var])
+            for var in chosen[1:]
+        ]
+        for child in inputs:
+            child = child.share(tensor_library)
+            child.condition(assignment)
+            factors.append(child)
+        for factor in factors:
+            product.join_with(tensor_library, factor, {})
+
+        product.materialize(tensor_library)
+        index = tensor_library.argmax(product.base)
+        for var in reversed(product.variables):
+            assignment[var] = index % 2
+            index //= 2
 
 
 if __name__ == "__main__":
@@ -1,4 +1,12 @@
+import array
+import collections
 import itertools
+import os
+import queue
+import select
+import threading
+
+import tensor_network
 
 
 class JoinTreeNode:
@@ -6,6 +14,8 @@ class JoinTreeNode:
     A simple class for an internal join tree node.
     """
 
+    __slots__ = ("_children", "_projected")
+
     def __init__(self, children, projected):
         self._children = children
         self._projected = projected
@@ -25,9 +35,18 @@ class JoinTreeNode:
         )
 
 
+JoinTreeStats = collections.namedtuple(
+    "JoinTreeStats", ["tensor_width", "add_width", "flops", "memory"]
+)
+
+
 class JoinTree:
     """
     A class representing a join tree.
+
+    Internal nodes are stored in flat arrays: the children of the i-th added node are
+    self._children[self._child_offsets[i]:self._child_offsets[i + 1]], and similarly
+    for its projected variables.
     """
 
     def __init__(self, num_leaves, root):
@@ -38,9 +57,15 @@ class JoinTree:
         :param root: The root of the join tree.
         """
         self._num_clauses = num_leaves
-        self._nodes = {}
         self._root = root
 
+        self._ids = array.array("q")
+        self._positions = array.array("q")  # Indexed by node id - num_leaves - 1
+        self._child_offsets = array.array("q", [0])
+        self._children = array.array("q")
+        self._projected_offsets = array.array("q", [0])
+        self._projected = array.array("q")
+
     def add_node(self, node_id, children, projected):
         """
         Add an internal node to the join tree.
@@ -50,9 +75,30 @@ class JoinTree:
         :param projected: The list of variables to project.
         :return: None
         """
-        self._nodes[node_id] = JoinTreeNode(children, projected)
+        slot = node_id - self._num_clauses - 1
+        if slot >= len(self._positions):
+            self._positions.extend([-1] * (slot + 1 - len(self._positions)))
+        self._positions[slot] = len(self._ids)
+
+        self._ids.append(node_id)
+        self._children.extend(children)
+        self._child_offsets.append(len(self._children))
+        self._projected.extend(projected)
+        self._projected_offsets.append(len(self._projected))
+
+    def _node(self, node_id):
+        """
+        Get a view of an internal node of the join tree.
+        """
+        i = self._positions[node_id - self._num_clauses - 1]
+        return JoinTreeNode(
+            self._children[self._child_offsets[i] : self._child_offsets[i + 1]],
+            self._projected[
+                self._projected_offsets[i] : self._projected_offsets[i + 1]
+            ],
+        )
 
-    def visit(self, at_internal_node, at_leaf):
+    def visit(self, at_internal_node, at_leaf, at_waiting=None, memo=None):
         """
         Visit all nodes of the join tree in a postorder traversal.
 
@@ -60,6 +106,11 @@ class JoinTree:
                                  Takes [list of child results] and [projected variables] as arguments.
         :param at_leaf: Function to compute the result for a child node.
                          Takes [node id] as argument.
+        :param at_waiting: Function called after each internal node is computed.
+                           Takes [list of results waiting on their parent] as argument.
+        :param memo: An object with methods get(node id), which returns a known result
+                     at an internal node (whose subtree is then not visited) or None,
+                     and put(node id, result), which is called with each computed result.
         :return: The result at the root node.
         """
         processed = [(self._root, False)]
@@ -73,134 +124,358 @@ class JoinTree:
                 # We have visited all children of this internal node
 
                 # Gather the child results
-                num_children = len(self._nodes[node].children)
+                num_children = len(self._node(node).children)
                 children_results = result_stack[-num_children:]
                 del result_stack[-num_children:]
 
                 # Compute the result at this node
                 result_stack.append(
-                    at_internal_node(children_results, self._nodes[node].projected)
+                    at_internal_node(children_results, self._node(node).projected)
                 )
-                pass
+                if memo is not None:
+                    memo.put(node, result_stack[-1])
+                if at_waiting is not None:
+                    at_waiting(result_stack)
             else:
+                known = None if memo is None else memo.get(node)
+                if known is not None:
+                    result_stack.append(known)
+                    continue
                 processed.append((node, True))
-                processed.extend((child, False) for child in self._nodes[node].children)
+                processed.extend((child, False) for child in self._node(node).children)
         return result_stack.pop()
 
-    def _get_costs(self, formula, join_cost):
-        costs = []
+    def visit_parallel(
+        self,
+        at_internal_node,
+        at_leaf,
+        workers,
+        result_memory=lambda _: 0,
+        memory_budget=0,
+        other_memory=lambda: 0,
+        at_waiting=None,
+        memo=None,
+    ):
+        """
+        Visit all nodes of the join tree, computing independent subtrees in parallel.
 
-        def at_leaf_node(node_id):
-            variables = {abs(lit) for lit in formula.clause(node_id - 1)}
-            return variables
+        Internal nodes are computed on a pool of worker threads once the results of all
+        their children are available; leaves are computed by the worker that handles
+        their parent. Among the nodes that are ready, those earliest in a postorder
+        traversal are started first.
 
-        def at_internal_node(children, projected_vars):
-            if len(children) == 1:
-                total_variables = children[0]
-                for variable in projected_vars:
-                    total_variables.discard(variable)
-                return total_variables
-
-            total_variables = children[0]
-            for i, variables in enumerate(children[1:]):
-                costs.append(
-                    join_cost(
-                        total_variables,
-                        variables,
-                        projected_vars if i == len(children) - 1 else [],
+        :param at_internal_node: Function to compute the result for an internal node.
+                                 Takes [list of child results] and [projected variables] as arguments.
+        :param at_leaf: Function to compute the result for a child node.
+                         Takes [node id] as argument.
+        :param workers: The number of worker threads to use.
+        :param result_memory: Function to estimate the memory held by the result at a node.
+                              Takes [node id] as argument.
+        :param memory_budget: The memory that results may hold before no further nodes
+                              are started (0 indicates no limit). A node is always started
+                              if no other node is running.
+        :param other_memory: Function that returns the memory held outside of the results
+                             (e.g. by the tensor library), which counts against the budget.
+        :param at_waiting: Function called after each internal node is computed.
+                           Takes [list of results waiting on their parent] as argument.
+        :param memo: As in visit.
+        :return: The result at the root node.
+        """
+        if self._root <= self._num_clauses:
+            return at_leaf(self._root)
+        known = {}  # Results found by the memo, whose subtrees are not visited
+        if memo is not None:
+            root_result = memo.get(self._root)
+            if root_result is not None:
+                return root_result
+
+        # Find the parent and postorder position of each internal node to compute
+        parent = {}
+        order = {}
+        processed = [(self._root, False)]
+        while len(processed) > 0:
+            node, expanded = processed.pop()
+            if expanded:
+                order[node] = len(order)
+            else:
+                processed.append((node, True))
+                for child in self._node(node).children:
+                    if child <= self._num_clauses:
+                        continue
+                    child_result = None if memo is None else memo.get(child)
+                    if child_result is not None:
+                        known[child] = child_result
+                    else:
+                        parent[child] = node
+                        processed.append((child, False))
+
+        waiting = {
+            node: sum(1 for c in self._node(node).children if c in order)
+            for node in order
+        }
+        ready = [node for node in order if waiting[node] == 0]
+        started = set()
+        results = {}
+        held_memory = 0
+        running = 0
+
+        tasks = queue.Queue()
+        finished = queue.Queue()
+
+        def work():
+            while True:
+                node = tasks.get()
+                if node is None:
+                    return
+                try:
+                    children_results = [
+                        at_leaf(child)
+                        if child <= self._num_clauses
+                        else known[child]
+                        if child in known
+                        else results[child]
+                        for child in self._node(node).children
+                    ]
+                    result = at_internal_node(
+                        children_results, self._node(node).projected
                     )
-                )
-                total_variables.update(variables)
+                    finished.put((node, result, None))
+                except BaseException as e:
+                    finished.put((node, None, e))
+
+        for _ in range(workers):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                # Start as many ready nodes as the workers and memory budget allow
+                ready.sort(key=lambda n: order[n], reverse=True)
+                while len(ready) > 0 and running < workers:
+                    node = ready[-1]
+                    memory = held_memory + other_memory() + result_memory(node)
+                    if running > 0 and 0 < memory_budget < memory:
+                        break
+                    ready.pop()
+                    held_memory += result_memory(node)
+                    running += 1
+                    started.add(node)
+                    tasks.put(node)
+
+                node, result, error = finished.get()
+                running -= 1
+                if error is not None:
+                    raise error
+                if memo is not None:
+                    memo.put(node, result)
+
+                # Release the results of the children, which are no longer needed
+                for child in self._node(node).children:
+                    known.pop(child, None)
+                    if child in results:
+                        del results[child]
+                        held_memory -= result_memory(child)
+
+                if node == self._root:
+                    return result
+                results[node] = result
+                waiting[parent[node]] -= 1
+                if waiting[parent[node]] == 0:
+                    ready.append(parent[node])
+                if at_waiting is not None:
+                    at_waiting(
+                        [
+                            results[n]
+                            for n in sorted(results, key=lambda n: order[n])
+                            if parent[n] not in started
+                        ]
+                    )
+        finally:
+            # Stop the workers once they finish their current node
+            for _ in range(workers):
+                tasks.put(None)
 
-            for variable in projected_vars:
-                total_variables.discard(variable)
-            return total_variables
+    def fold(self, at_internal_node, at_leaf):
+        """
+        Compute a value at every node of the join tree from the values at its children.
 
-        _ = self.visit(at_internal_node, at_leaf_node)
-        return costs
+        :param at_internal_node: Function to compute the value for an internal node.
+                                 Takes [list of child values] and [projected variables] as arguments.
+        :param at_leaf: Function to compute the value for a leaf.
+                        Takes [node id] as argument.
+        :return: A dictionary of the value at each node, by node id.
+        """
+        values = {}
+        processed = [(self._root, False)]
+        while len(processed) > 0:
+            node, expanded = processed.pop()
+            if node <= self._num_clauses:
+                values[node] = at_leaf(node)
+            elif expanded:
+                node_info = self._node(node)
+                values[node] = at_internal_node(
+                    [values[child] for child in node_info.children], node_info.projected
+                )
+            else:
+                processed.append((node, True))
+                processed.extend((child, False) for child in self._node(node).children)
+        return values
 
-    def _compute_width(self, formula, score_join):
-        def at_leaf_node(node_id):
-            variables = {abs(lit) for lit in formula.clause(node_id - 1)}
-            return variables, len(variables)
+    def is_graded(self, is_inner):
+        """
+        Check that this join tree is graded, i.e. that every node that projects an inner
+        variable has no node in its subtree (including itself) that projects an outer
+        variable. The inner variables can then be projected existentially.
+
+        :param is_inner: Function that returns true for each inner variable
+        :return: True if the join tree is graded
+        """
 
         def at_internal_node(children, projected_vars):
-            if len(children) == 1:
-                total_variables = children[0]
-                for variable in projected_vars:
-                    total_variables.discard(variable)
-                return total_variables, children[0]
-
-            total_variables, highest_width = children[0]
-            for i in enumerate(children[1:]):
-                variables, width = children[i]
-                intermediate_width = score_join(
-                    total_variables,
-                    variables,
-                    projected_vars if i == len(children) - 1 else [],
-                )
-                total_variables.update(variables)
-                highest_width = max(highest_width, width, intermediate_width)
+            # Whether the subtree projects an outer variable, or None if not graded
+            if None in children:
+                return None
+            projects_outer = any(children) or any(
+                not is_inner(var) for var in projected_vars
+            )
+            if projects_outer and any(is_inner(var) for var in projected_vars):
+                return None
+            return projects_outer
 
-            for variable in projected_vars:
-                total_variables.discard(variable)
-            return total_variables, highest_width
+        return self.fold(at_internal_node, lambda _: False)[self._root] is not None
+
+    def node_variables(self, formula, sliced=frozenset()):
+        """
+        Compute the variables of the result at each internal node.
 
-        _, result = self.visit(at_internal_node, at_leaf_node)
+        :param formula: The formula whose clauses are the leaves of this join tree
+        :param sliced: Variables that are fixed to a value, and so do not appear
+        :return: A dictionary mapping each internal node to its set of variables
+        """
+        result = {}
+        processed = [(self._root, False)]
+        while len(processed) > 0:
+            node, expanded = processed.pop()
+            if node <= self._num_clauses:
+                continue
+            elif expanded:
+                variables = set()
+                for child in self._node(node).children:
+                    if child <= self._num_clauses:
+                        variables.update(abs(lit) for lit in formula.clause(child - 1))
+                    else:
+                        variables.update(result[child])
+                result[node] = variables - set(self._node(node).projected) - sliced
+            else:
+                processed.append((node, True))
+                processed.extend((child, False) for child in self._node(node).children)
         return result
 
-    def add_width(self, formula):
+    def analyze(self, formula, sliced=frozenset(), max_width=None, stopped=None):
         """
-        Compute the width when ADDs are used to execute this join tree.
+        Compute the widths, flops, and peak memory of this join tree in a single
+        postorder pass. Only the sets of variables of the results on the stack are kept,
+        so each node costs time in its width rather than in the number of variables.
+
+        At each internal node, the children are joined in the order chosen by
+        plan_joins, as during execution. Leaves are implicit clause tensors and so hold
+        no memory.
+
+        :param formula: The formula whose clauses are the leaves of this join tree
+        :param sliced: Variables that are fixed to a value, and so do not appear in tensors
+        :param max_width: If given, abandon the analysis once the tensor width exceeds this
+        :param stopped: If given, an event that abandons the analysis once it is set
+        :return: A JoinTreeStats of the tensor width, the ADD width, the number of flops,
+                 and the peak number of tensor entries held at once,
+                 or None if the analysis was abandoned
         """
+        sliced = set(sliced)
+
+        tensor_width = 0
+        add_width = 0
+        flops = 0
+        held = 0  # Entries held by the results on the stack
+        peak = 0
 
-        def score_add_join(left, right, _):
-            return len(left | right)
+        result_stack = []  # Pairs of (variables, entries) for each result
+        processed = [(self._root, False)]
+        while len(processed) > 0:
+            node, expanded = processed.pop()
+            if node <= self._num_clauses:
+                variables = {abs(lit) for lit in formula.clause(node - 1)} - sliced
+                tensor_width = max(tensor_width, len(variables))
+                add_width = max(add_width, len(variables))
+                result_stack.append((variables, 0))
+                if max_width is not None and tensor_width > max_width:
+                    return None
+            elif expanded:
+                if stopped is not None and stopped.is_set():
+                    return None
+                node_info = self._node(node)
+                num_children = len(node_info.children)
+                children = result_stack[len(result_stack) - num_children :]
+                del result_stack[len(result_stack) - num_children :]
+
+                # Join the children in the order of execution
+                initial, steps = tensor_network.plan_joins(
+                    [variables for variables, _ in children],
+                    set(node_info.projected) - sliced,
+                )
+                operands = [
+                    variables - exclusive
+                    for (variables, _), exclusive in zip(children, initial)
+                ]
+                result = operands[0] if num_children > 0 else set()
+                joined_entries = []  # Entries held by the result of each join
+                for left, right, summed in steps:
+                    both = operands[left] | operands[right]
+                    result = both - summed
+                    tensor_width = max(
+                        tensor_width,
+                        len(operands[left]),
+                        len(operands[right]),
+                        len(result),
+                    )
+                    add_width = max(add_width, len(both))
+                    flops += 2 ** min(len(both), 100)  # Cap
+                    joined_entries.append(2 ** min(len(result), 100))
+                    peak = max(peak, held + sum(joined_entries))
+                    for operand in (left, right):
+                        if operand >= num_children:
+                            joined_entries[operand - num_children] = 0
+                    operands.append(result)
+                if max_width is not None and tensor_width > max_width:
+                    return None
+
+                held -= sum(entries for _, entries in children)
+                entries = 2 ** min(len(result), 100)
+                held += entries
+                peak = max(peak, held)
+                result_stack.append((result, entries))
+            else:
+                processed.append((node, True))
+                processed.extend((child, False) for child in self._node(node).children)
 
-        highest_clause_length = max(len({abs(v) for v in c}) for c in formula.clauses)
-        highest_join_length = max(self._get_costs(formula, score_add_join))
-        return max(highest_clause_length, highest_join_length)
+        return JoinTreeStats(tensor_width, add_width, flops, peak)
 
-    def tensor_width(self, formula):
+    def add_width(self, formula):
         """
-        Compute the width when tensors are used to execute this join tree.
+        Compute the width when ADDs are used to execute this join tree.
         """
+        return self.analyze(formula).add_width
 
-        def score_tensor_join(left, right, projected_vars):
-            var_both = [var for var in left if var in right]
-            left_size = len(left)
-            right_size = len(right)
-            for var in reversed(var_both):
-                if var not in projected_vars:
-                    # Non-projected variable that appears in both must be duplicated
-                    if left_size <= right_size:
-                        left_size += 1
-                    else:
-                        right_size += 1
-            result_size = left_size + right_size - 2 * len(var_both)
-            return max(left_size, right_size, result_size)
-
-        highest_clause_length = max(len({abs(v) for v in c}) for c in formula.clauses)
-        highest_join_length = max(self._get_costs(formula, score_tensor_join))
-        return max(highest_clause_length, highest_join_length)
-
-    def tensor_flops(self, formula):
-        def flops_tensor_join(left, right, projected_vars):
-            var_both = [var for var in left if var in right]
-            total_axes = (
-                len(left)
-                + len(right)
-                + sum(1 for var in var_both if var not in projected_vars)
-            )
+    def tensor_width(self, formula, sliced=frozenset()):
+        """
+        Compute the width when tensors are used to execute this join tree.
 
-            log_num_sums = total_axes - 2 * len(var_both)
-            log_terms_in_sum = len(var_both)
-            if log_num_sums + log_terms_in_sum > 100:
-                return 2 ** 100  # Cap
-            else:
-                return 2 ** (log_num_sums + log_terms_in_sum)
+        :param formula: The formula whose clauses are the leaves of this join tree
+        :param sliced: Variables that are fixed to a value, and so do not appear in tensors
+        """
+        return self.analyze(formula, sliced=sliced).tensor_width
 
-        return sum(self._get_costs(formula, flops_tensor_join))
+    def tensor_flops(self, formula, sliced=frozenset()):
+        return self.analyze(formula, sliced=sliced).flops
 
     @staticmethod
     def parse_jt(file, log=lambda _: None):
@@ -256,14 +531,157 @@ class JoinTree:
         return result, gen_time, pid
 
     def write(self, file):
-        max_var = max(
-            max(self._nodes[node].projected)
-            for node in self._nodes
-            if len(self._nodes[node].projected) > 0
-        )
+        max_var = max(self._projected)
         file.write(
             " ".join(["p jt", str(max_var), str(self._num_clauses), str(self._root)])
         )
         file.write("\n")
-        for node in self._nodes:
-            file.write(str(node) + " " + str(self._nodes[node]) + "\n")
+        for node in self._ids:
+            file.write(str(node) + " " + str(self._node(node)) + "\n")
+
+
+class JoinTreePipeline:
+    """
+    Parse and analyze the join trees of a stream on a background thread, as they arrive.
+
+    Only join trees of strictly smaller tensor width than every earlier join tree are
+    reported, and the analysis of any other join tree is abandoned as soon as its partial
+    width reaches the best width so far. If the formula is projected, join trees that
+    are not graded are skipped. The reader blocks until the next improvement is
+    reported (or the stream ends) instead of polling.
+
+    Call stop once no further join trees are needed, so that the background thread ends.
+    """
+
+    def __init__(
+        self,
+        file,
+        formula,
+        log=lambda _: None,
+        check_timeout=lambda: None,
+        stop_stream=lambda: None,
+    ):
+        """
+        :param file: A handler to the stream of join trees to read
+        :param formula: The formula whose clauses are the leaves of the join trees
+        :param log: Function to print messages
+        :param check_timeout: Function to call when the reader is woken (see wake), which
+                              raises a TimeoutError once the timeout passes
+        :param stop_stream: Function to call on stop to end a stream that has no file
+                            descriptor (e.g. by shutting down its socket), since waits on
+                            it cannot otherwise be interrupted
+        """
+        self.pid = None  # The latest pid of the planner
+        self._improvements = queue.Queue()
+        self._check_timeout = check_timeout
+        self._stop_stream = stop_stream
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, args=(file, formula, log))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, file, formula, log):
+        best_width = None
+        try:
+            lines = _read_lines(file, self._stopped)
+            while not self._stopped.is_set():
+                join_tree, gen_time, pid = JoinTree.parse_jt(lines, log=log)
+                if pid is not None:
+                    self.pid = pid
+                if join_tree is None or self._stopped.is_set():
+                    break
+                if formula.outer_variables is not None and not join_tree.is_graded(
+                    formula.is_inner
+                ):
+                    log("Skipped join tree that is not graded")
+                    continue
+
+                bound = None if best_width is None else best_width - 1
+                stats = join_tree.analyze(
+                    formula, max_width=bound, stopped=self._stopped
+                )
+                if self._stopped.is_set():
+                    break
+                if stats is None:
+                    log("Abandoned join tree with tensor width above " + str(bound))
+                    continue
+
+                log("Parsed join tree with tensor width " + str(stats.tensor_width))
+                best_width = stats.tensor_width
+                self._improvements.put((join_tree, stats, gen_time))
+        except Exception as e:
+            self._improvements.put(e)
+        finally:
+            self._improvements.put(None)
+
+    def stop(self):
+        """
+        Stop parsing and analyzing join trees. The background thread abandons the
+        analysis of its current join tree and ends soon after, without being waited on.
+
+        :return: None
+        """
+        self._stopped.set()
+        self._stop_stream()
+
+    def wake(self):
+        """
+        Wake a thread waiting for the next join tree, without reporting one, so that it
+        checks the timeout.
+
+        :return: None
+        """
+        self._improvements.put(self._improvements)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Wait for the next join tree that improves the tensor width.
+
+        :return: The join tree, its JoinTreeStats, and the time taken to generate it
+        """
+        item = self._improvements.get()
+        while item is self._improvements:  # Woken by wake()
+            self._check_timeout()
+            item = self._improvements.get()
+        if item is None:
+            self._improvements.put(None)  # Later calls also stop
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+def _read_lines(file, stopped):
+    """
+    Iterate over the lines of the file, until the provided event is set.
+
+    Where possible, the underlying file descriptor is read directly, so that a thread
+    waiting on the file does not hold the lock of its buffer (which would otherwise
+    abort the interpreter at exit), and waits for data check the event periodically.
+    """
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError, ValueError):
+        for line in file:
+            if stopped.is_set():
+                return
+            yield line
+        return
+
+    pending = b""
+    while not stopped.is_set():
+        if len(select.select([fd], [], [], 0.1)[0]) == 0:
+            continue
+        chunk = os.read(fd, 2 ** 16)
+        if len(chunk) == 0:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode() + "\n"
+    if len(pending) > 0 and not stopped.is_set():
+        yield pending.decode()
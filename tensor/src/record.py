@@ -54,14 +54,8 @@ def run(formula, join_tree, store, output, timeout):
                     pid = new_pid
                 if jt is None:
                     break
-                log.append(
-                    (
-                        gen_time,
-                        jt.add_width(formula),
-                        jt.tensor_width(formula),
-                        jt.tensor_flops(formula),
-                    )
-                )
+                stats = jt.analyze(formula)
+                log.append((gen_time, stats.add_width, stats.tensor_width, stats.flops))
                 if store is not None:
                     log_trees.append((store + "/" + str(len(log)) + ".jt", jt))
         except TimeoutError:
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+
+import click
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+import execute
+import tensor_network
+import util
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Execute one job sent over a connection.
+
+    The client first sends a line with a JSON object, whose "args" are the options of
+    execute.py and whose optional "formula" is the text of the formula (in place of a
+    --formula file). The join tree stream follows, until the client stops writing.
+    The same key/value output as execute.py is sent back.
+
+    The results of subtrees are kept in the cache of the server (if any), so that a later
+    job on a formula that differs in only a few clauses or weights recomputes only the
+    subtrees that changed.
+    """
+
+    def handle(self):
+        output = util.KeyValueOutput.wrap(_SocketOutput(self.wfile))
+        try:
+            header = json.loads(self.rfile.readline().decode())
+            args = list(header.get("args", []))
+            if "formula" in header:
+                args += ["--formula", "-"]
+            options = execute.run.make_context("execute.py", args).params
+
+            if "formula" in header:
+                options["formula"] = io.StringIO(header["formula"])
+            options["join_tree"] = (line.decode() for line in self.rfile)
+            options["output"] = output
+            execute.execute_job(
+                **options,
+                timer_type=util.ThreadTimeoutTimer,
+                cache=self.server.cache,
+                stop_join_tree=self._stop_reading,
+            )
+        except click.ClickException as e:
+            util.log("Invalid job: " + e.format_message(), flush=True)
+            output.output_pair("Error", "job usage")
+        except:
+            util.log("Error during job", flush=True)
+            util.log(traceback.format_exc())
+            output.output_pair("Error", "job unknown error")
+        finally:
+            # Wake the reader of the join tree stream, if it is still waiting
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _stop_reading(self):
+        """
+        End the join tree stream, so that the thread reading it stops.
+        """
+        try:
+            self.request.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+
+class _SocketOutput:
+    def __init__(self, wfile):
+        self._wfile = wfile
+
+    def write(self, s):
+        self._wfile.write(s.encode())
+
+
+@click.command(context_settings={
+    "max_content_width": 105,
+    "help_option_names": ["-h", "--help"],
+    "show_default": True,
+})
+@click.option("--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="Unix socket to listen for jobs on.",
+)
+@click.option("--cache_budget",
+    type=float,
+    default=1.0,
+    help="Memory (GB) for the results of subtrees kept between jobs. 0 disables the cache.",
+)
+def serve(socket_path, cache_budget):
+    """
+    Run the tensor executor as a server, which keeps the interpreter and the tensor
+    library loaded between jobs. Jobs run at once in separate threads, each with its
+    own timeout. Submit jobs with client.py.
+    """
+    sys.setrecursionlimit(100000)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+    server.daemon_threads = True
+    server.cache = None
+    if cache_budget > 0:
+        server.cache = tensor_network.ResultCache(cache_budget * 2 ** 30)
+    util.log("Listening on " + socket_path, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    serve()
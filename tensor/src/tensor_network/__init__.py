@@ -1,5 +1,12 @@
 # from tensor_network.tensor_network import TensorNetwork
 from tensor_network.tensor import Tensor
+from tensor_network.join_order import plan_joins
+from tensor_network.spill import Spiller
+from tensor_network.cache import ResultCache
+from tensor_network.hadamard import contract_xor_clauses
+from tensor_network.modular import scale_weights, choose_moduli, reconstruct
+from tensor_network.rescale import to_scientific, add_scientific
+from tensor_network.semiring import ALL_SEMIRINGS
 from tensor_network.tensor_apis import ALL_APIS
 
 # from tensor_network.tensor_network_constructions import ALL_CONSTRUCTIONS
@@ -0,0 +1,103 @@
+import collections
+import hashlib
+import threading
+
+from tensor_network.tensor import Tensor
+
+
+class ResultCache:
+    """
+    Keep the results of join tree nodes between executions, so that a later execution
+    reuses the result of every subtree that is unchanged.
+
+    Results are keyed by a hash of everything that determines them (see key), and the
+    least recently used results are evicted once they hold too much memory.
+    """
+
+    def __init__(self, memory_budget):
+        """
+        :param memory_budget: The memory (bytes) that cached results may hold
+        """
+        self._memory_budget = memory_budget
+        self._results = collections.OrderedDict()
+        self._held = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hash the provided parts (bytes, arrays, or values with a stable repr) into a key.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            if isinstance(part, bytes):
+                digest.update(part)
+            elif hasattr(part, "tobytes"):
+                digest.update(part.tobytes())
+            else:
+                digest.update(repr(part).encode())
+            digest.update(b"|")
+        return digest.digest()
+
+    def get(self, key):
+        """
+        :return: A new tensor that shares the (read-only) entries of the cached result,
+                 or None if there is no result for the key
+        """
+        with self._lock:
+            if key not in self._results:
+                return None
+            self._results.move_to_end(key)
+            result = self._results[key]
+        return Tensor(
+            result.base, list(result.variables), result.implicit, result.log_scale
+        )
+
+    def put(self, tensor_library, key, result):
+        """
+        Cache the provided result, whose entries become read-only.
+
+        :param tensor_library: The underlying tensor library
+        :param key: The key of the result
+        :param result: The tensor to cache
+        :return: None
+        """
+        size = 0 if result.base is None else result.base.nbytes
+        if size > self._memory_budget:
+            return
+        result = result.share(tensor_library)
+        with self._lock:
+            if key in self._results:
+                return
+            self._results[key] = result
+            self._held += size
+            while self._held > self._memory_budget:
+                _, evicted = self._results.popitem(last=False)
+                self._held -= 0 if evicted.base is None else evicted.base.nbytes
+
+    def memo(self, tensor_library, keys):
+        """
+        :param tensor_library: The underlying tensor library
+        :param keys: The key of each node of a join tree, by node id
+        :return: An object to pass as the memo of JoinTree.visit, which looks up and
+                 caches the result of each node under its key
+        """
+        return _NodeMemo(self, tensor_library, keys)
+
+
+class _NodeMemo:
+    def __init__(self, cache, tensor_library, keys):
+        self._cache = cache
+        self._tensor_library = tensor_library
+        self._keys = keys
+        self.hits = 0
+
+    def get(self, node):
+        result = self._cache.get(self._keys[node])
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def put(self, node, result):
+        if result is not None:
+            self._cache.put(self._tensor_library, self._keys[node], result)
@@ -0,0 +1,50 @@
+from tensor_network.tensor import Tensor
+
+
+def contract_xor_clauses(
+    tensor_library, clauses, assignment, projected_weights, variables
+):
+    """
+    Contract a subtree of XOR clauses in the Hadamard (GF(2) Fourier) domain.
+
+    Each parity constraint [a.x = t] is (1 + (-1)^(t + a.x)) / 2, i.e. diagonal in the
+    Hadamard basis. So for each assignment y of one bit to each of the m constraints,
+    the sum over every projected variable factorizes into a product of transformed
+    weights. These terms are gathered by the Hadamard coefficient of the remaining
+    variables, and transformed back by a fast Walsh-Hadamard transform:
+
+        result(x) = 2^-m sum_y (-1)^(y.t) prod_v w_v((y.A)_v) (-1)^((y.A).x)
+
+    where w_v(0) = w_v[0] + w_v[1] and w_v(1) = w_v[0] - w_v[1] for projected v.
+
+    This takes time 2^m (rather than exponential in the width of the subtree), and so
+    should be used when the subtree has few clauses.
+
+    :param tensor_library: The underlying tensor library (with float entries)
+    :param clauses: The literals of each XOR clause of the subtree
+    :param assignment: Variables that are fixed to a value (0 or 1)
+    :param projected_weights: The variables projected within the subtree, mapped to their
+                              weights
+    :param variables: The variables of the result
+    :return: The resulting tensor
+    """
+    constraints = [Tensor.xor_parity(clause, assignment) for clause in clauses]
+    summed = sorted(
+        {var for parity, _ in constraints for var in parity if var in projected_weights}
+    )
+    columns = summed + list(variables)
+    parity = [[parity.get(var, 0) for var in columns] for parity, _ in constraints]
+    spectrum = tensor_library.xor_spectrum(
+        parity,
+        [target for _, target in constraints],
+        [
+            (
+                projected_weights[var][0] + projected_weights[var][1],
+                projected_weights[var][0] - projected_weights[var][1],
+            )
+            for var in summed
+        ],
+        len(variables),
+    )
+    result = tensor_library.fwht(spectrum) * 0.5 ** len(constraints)
+    return Tensor(result, list(variables))
@@ -0,0 +1,149 @@
+def plan_joins(child_variables, projected_vars, max_exact_arity=6):
+    """
+    Choose the order of pairwise joins that combines the tensors at an internal node.
+
+    Each join costs one multiply-add for every assignment to the variables of both
+    tensors, and a projected variable is summed out as soon as it appears in only
+    one remaining tensor. An order of minimum total cost is found exactly for small
+    arity; otherwise the cheapest available join is greedily performed at each step.
+
+    :param child_variables: A list containing the set of variables of each child tensor
+    :param projected_vars: The variables to project out at this node
+    :param max_exact_arity: The largest number of children for which to find an optimal order
+    :return: A list containing, for each child, the variables to project out before any join,
+             and a list of steps (left, right, projected). Each step joins the tensors at
+             positions left and right, then projects out the listed variables. The result
+             of step k is placed at position len(child_variables) + k.
+    """
+    occurrences = {var: 0 for var in projected_vars}
+    for variables in child_variables:
+        for var in variables:
+            if var in occurrences:
+                occurrences[var] += 1
+
+    initial = [
+        {var for var in variables if occurrences.get(var, 0) == 1}
+        for variables in child_variables
+    ]
+    operands = [
+        set(variables) - projected
+        for variables, projected in zip(child_variables, initial)
+    ]
+    if len(operands) <= 1:
+        return initial, []
+    if len(operands) == 2:
+        # Every remaining projected variable appears in both children
+        projected = {var for var in operands[0] & operands[1] if var in projected_vars}
+        return initial, [(0, 1, projected)]
+
+    if len(operands) <= max_exact_arity:
+        steps = _optimal_steps(operands, projected_vars)
+    else:
+        steps = _greedy_steps(operands, projected_vars)
+    return initial, steps
+
+
+def _optimal_steps(operands, projected_vars):
+    """
+    Find the order of minimum total cost through dynamic programming over subsets.
+    """
+    num = len(operands)
+    full = (1 << num) - 1
+
+    # The children that contain each projected variable
+    holders = {}
+    for i, variables in enumerate(operands):
+        for var in variables:
+            if var in projected_vars:
+                holders[var] = holders.get(var, 0) | (1 << i)
+
+    # The variables remaining after joining each subset of children
+    union = [set() for _ in range(full + 1)]
+    remaining = [set() for _ in range(full + 1)]
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        union[mask] = union[mask ^ low] | operands[low.bit_length() - 1]
+        remaining[mask] = {
+            var
+            for var in union[mask]
+            if var not in holders or holders[var] & ~mask != 0
+        }
+
+    cost = [0] * (full + 1)
+    split = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        if mask == low:
+            continue
+
+        # Enumerate each split once by keeping the lowest child on the left
+        rest = mask ^ low
+        sub = rest
+        while True:
+            left = low | sub
+            right = mask ^ left
+            if right != 0:
+                total = (
+                    cost[left]
+                    + cost[right]
+                    + 2 ** len(remaining[left] | remaining[right])
+                )
+                if split[mask] == 0 or total < cost[mask]:
+                    cost[mask] = total
+                    split[mask] = left
+            if sub == 0:
+                break
+            sub = (sub - 1) & rest
+
+    steps = []
+
+    def emit(mask):
+        if mask & (mask - 1) == 0:
+            return mask.bit_length() - 1
+        left, right = split[mask], mask ^ split[mask]
+        left_index = emit(left)
+        right_index = emit(right)
+        projected = (remaining[left] | remaining[right]) - remaining[mask]
+        steps.append((left_index, right_index, projected))
+        return num + len(steps) - 1
+
+    emit(full)
+    return steps
+
+
+def _greedy_steps(operands, projected_vars):
+    """
+    Repeatedly perform the join with the fewest variables involved.
+    """
+    alive = {i: variables for i, variables in enumerate(operands)}
+    occurrences = {}
+    for variables in operands:
+        for var in variables:
+            if var in projected_vars:
+                occurrences[var] = occurrences.get(var, 0) + 1
+
+    steps = []
+    while len(alive) > 1:
+        best = None
+        indices = sorted(alive)
+        for i, left in enumerate(indices):
+            for right in indices[i + 1 :]:
+                both = alive[left] | alive[right]
+                projected = {
+                    var
+                    for var in alive[left] & alive[right]
+                    if occurrences.get(var, 0) == 2
+                }
+                score = (len(both), len(both) - len(projected))
+                if best is None or score < best[0]:
+                    best = (score, left, right, projected)
+
+        _, left, right, projected = best
+        for var in alive[left] & alive[right]:
+            if var in occurrences:
+                occurrences[var] -= 1
+        alive[len(operands) + len(steps)] = (
+            alive.pop(left) | alive.pop(right)
+        ) - projected
+        steps.append((left, right, projected))
+    return steps
@@ -0,0 +1,98 @@
+import fractions
+import math
+
+# Moduli are below 2^26, so that 2^11 products of residues can be summed in an int64
+MAX_MODULUS = 2 ** 26
+
+
+def scale_weights(neg_weight, pos_weight):
+    """
+    Scale the weights of a variable to integers, by the least common denominator of
+    both weights.
+
+    :param neg_weight: The weight of the negative literal (a Fraction, or a float,
+                       which is a dyadic rational)
+    :param pos_weight: The weight of the positive literal
+    :return: The scaled negative weight, the scaled positive weight, and the
+             denominator that they were multiplied by
+    """
+    neg_weight = fractions.Fraction(neg_weight)
+    pos_weight = fractions.Fraction(pos_weight)
+    denominator = (
+        neg_weight.denominator
+        * pos_weight.denominator
+        // math.gcd(neg_weight.denominator, pos_weight.denominator)
+    )
+    return (
+        neg_weight.numerator * (denominator // neg_weight.denominator),
+        pos_weight.numerator * (denominator // pos_weight.denominator),
+        denominator,
+    )
+
+
+def choose_moduli(bound):
+    """
+    Choose primes below MAX_MODULUS whose product exceeds twice the provided bound,
+    so that any integer of at most that magnitude is determined by its residues.
+
+    :param bound: An upper bound on the magnitude of the integer to reconstruct
+    :return: A list of distinct primes, largest first
+    """
+    moduli = []
+    product = 1
+    candidate = MAX_MODULUS - 1
+    while product <= 2 * bound:
+        if _is_prime(candidate):
+            moduli.append(candidate)
+            product *= candidate
+        candidate -= 2
+    return moduli
+
+
+def reconstruct(residues, moduli):
+    """
+    Find the integer of smallest magnitude with the provided residues,
+    by the Chinese remainder theorem.
+
+    :param residues: The residue of the integer modulo each modulus
+    :param moduli: Distinct primes
+    :return: The reconstructed integer
+    """
+    product = 1
+    for modulus in moduli:
+        product *= modulus
+    result = 0
+    for residue, modulus in zip(residues, moduli):
+        others = product // modulus
+        # The inverse of others modulo the prime, by Fermat's little theorem
+        inverse = pow(others % modulus, modulus - 2, modulus)
+        result += int(residue) * inverse % modulus * others
+    result %= product
+    if result > product // 2:
+        result -= product
+    return result
+
+
+def _is_prime(n):
+    """
+    Deterministic Miller-Rabin test, valid for all n below 3,215,031,751.
+    """
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7):
+        if n % p == 0:
+            return n == p
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for a in (2, 3, 5, 7):
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
@@ -0,0 +1,35 @@
+import math
+
+
+def to_scientific(value, log_scale=0.0):
+    """
+    Write value * 10^log_scale in scientific notation, which neither underflows nor
+    overflows even if the product is outside the range of a float.
+
+    :param value: A float
+    :param log_scale: The (base 10) logarithm of the factor of value
+    :return: The mantissa (with 1 <= |mantissa| < 10, or 0) and the integer exponent
+    """
+    if value == 0 or not math.isfinite(value):
+        return float(value), 0
+    log_value = math.log10(abs(value)) + log_scale
+    exponent = math.floor(log_value)
+    mantissa = math.copysign(10 ** (log_value - exponent), value)
+    if abs(mantissa) >= 10:
+        return mantissa / 10, exponent + 1
+    return mantissa, exponent
+
+
+def add_scientific(a, b):
+    """
+    :param a: A number in scientific notation (see to_scientific)
+    :param b: A number in scientific notation
+    :return: The sum of both, in scientific notation
+    """
+    if a[0] == 0:
+        return b
+    if b[0] == 0:
+        return a
+    if a[1] < b[1]:
+        a, b = b, a
+    return to_scientific(a[0] + b[0] * 10.0 ** (b[1] - a[1]), a[1])
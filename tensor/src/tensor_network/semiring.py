@@ -0,0 +1,75 @@
+import math
+
+
+class SumProduct:
+    """
+    The semiring of weighted model counting: variables are projected by a weighted sum.
+
+    Tensors use matrix products to join and sum at once in this semiring.
+    """
+
+    name = "sum-product"
+    maximizes = False
+    one = 1
+    zero = 0
+
+    def weight(self, weight):
+        """
+        :return: The element of the semiring for the provided literal weight
+        """
+        return weight
+
+    def add(self, tensor_library, a, b):
+        return a + b
+
+    def multiply(self, a, b):
+        return a * b
+
+
+class MaxProduct:
+    """
+    The semiring of weighted SAT (Boolean MPE): variables are projected by taking the
+    maximum over their weighted values.
+    """
+
+    name = "max-product"
+    maximizes = True
+    one = 1
+    zero = 0
+
+    def weight(self, weight):
+        return weight
+
+    def add(self, tensor_library, a, b):
+        return tensor_library.maximum(a, b)
+
+    def multiply(self, a, b):
+        return a * b
+
+
+class LogMaxSum:
+    """
+    The max-product semiring in the log domain, whose elements are the natural logarithm
+    of weights. Products of many small weights do not underflow.
+    """
+
+    name = "log-max-sum"
+    maximizes = True
+    one = 0.0
+    zero = -math.inf
+
+    def weight(self, weight):
+        return math.log(weight) if weight != 0 else -math.inf
+
+    def add(self, tensor_library, a, b):
+        return tensor_library.maximum(a, b)
+
+    def multiply(self, a, b):
+        return a + b
+
+
+ALL_SEMIRINGS = {
+    "sum-product": SumProduct(),
+    "max-product": MaxProduct(),
+    "log-max-sum": LogMaxSum(),
+}
@@ -0,0 +1,210 @@
+import numpy
+
+
+class SparseArray:
+    """
+    A tensor whose every index has size 2, stored as its nonzero entries only: the flat
+    (row-major) position of each entry in the 2^rank index space and its value.
+
+    Entries are never modified in place, so arrays can be shared freely. Positions are
+    int64, so the rank may be up to 62.
+    """
+
+    def __init__(self, rank, index, values):
+        """
+        :param rank: The number of indices of the tensor
+        :param index: The distinct flat positions of the nonzero entries (int64 array)
+        :param values: The value of each entry in index
+        """
+        self.shape = tuple(2 for _ in range(rank))
+        self.index = index
+        self.values = values
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.values.nbytes
+
+    @property
+    def density(self):
+        """
+        :return: The fraction of entries of the tensor that are nonzero
+        """
+        return len(self.index) / 2 ** len(self.shape)
+
+    @staticmethod
+    def from_dense(array):
+        """
+        :return: The sparse array with the entries of the provided dense array
+        """
+        index = numpy.flatnonzero(array).astype(numpy.int64)
+        return SparseArray(len(array.shape), index, numpy.reshape(array, -1)[index])
+
+    def to_dense(self):
+        """
+        :return: A dense array with the entries of this tensor
+        """
+        if len(self.shape) > 30:
+            raise RuntimeError("Requires tensor rank above 30")
+        result = numpy.zeros(2 ** len(self.shape), dtype=self.dtype)
+        result[self.index] = self.values
+        return result.reshape(self.shape)
+
+    def __getitem__(self, lookup):
+        """
+        Restrict some indices to a value, as for a dense array. Each element of lookup is
+        either a value (0 or 1) or slice(0, 2), optionally followed by an Ellipsis.
+
+        :return: The restricted sparse array, or the entry if every index is restricted
+        """
+        if not isinstance(lookup, tuple):
+            lookup = (lookup,)
+        lookup = [key for key in lookup if key is not Ellipsis]
+        rank = len(self.shape)
+        lookup += [slice(0, 2) for _ in range(rank - len(lookup))]
+
+        mask = numpy.ones(len(self.index), dtype=bool)
+        for axis, key in enumerate(lookup):
+            if not isinstance(key, slice):
+                mask &= _bits(self.index, rank, axis) == key
+        kept = [axis for axis, key in enumerate(lookup) if isinstance(key, slice)]
+        values = self.values[mask]
+        if len(kept) == 0:
+            return values[0] if len(values) > 0 else self.dtype.type(0)
+        # The restricted bits are equal for all remaining entries, which stay distinct
+        return SparseArray(len(kept), _select(self.index[mask], rank, kept), values)
+
+    def project(self, axes, weights):
+        """
+        Sum out the provided indices, weighting the entries at each value of an index by
+        the weight of that value.
+
+        :param axes: The indices to sum out
+        :param weights: The pair of weights of each index
+        :return: The resulting sparse array
+        """
+        rank = len(self.shape)
+        values = self.values
+        for axis, pair in zip(axes, weights):
+            pair = numpy.asarray(pair, dtype=self.dtype)
+            values = values * pair[_bits(self.index, rank, axis)]
+        kept = [axis for axis in range(rank) if axis not in axes]
+        return _aggregate(len(kept), _select(self.index, rank, kept), values)
+
+    def join(self, variables, other, other_variables, summed_weights):
+        """
+        Take the product of this tensor with the provided tensor, then project out the
+        provided variables (which must appear in both).
+
+        Entries are matched on the values of the variables of both tensors, as in a
+        relational join, so the work is proportional to the number of nonzero products.
+
+        :param variables: The variable that corresponds to each index of this tensor
+        :param other: The entries of the other tensor, either a sparse or a dense array
+        :param other_variables: The variable that corresponds to each index of other
+        :param summed_weights: The variables to project out, mapped to their weights
+        :return: The entries and variables of the resulting sparse tensor
+        """
+        var_both = [var for var in variables if var in other_variables]
+        summed = [var for var in var_both if var in summed_weights]
+        kept = [var for var in var_both if var not in summed_weights]
+        left_only = [var for var in variables if var not in other_variables]
+        right_only = [var for var in other_variables if var not in variables]
+        if len(kept) + len(left_only) + len(right_only) > 62:
+            raise RuntimeError("Requires tensor rank above 62")
+
+        rank, other_rank = len(variables), len(other_variables)
+        key = _select(self.index, rank, [variables.index(var) for var in var_both])
+        values = self.values
+        for var in summed:
+            pair = numpy.asarray(summed_weights[var], dtype=self.dtype)
+            values = values * pair[_bits(self.index, rank, variables.index(var))]
+
+        if isinstance(other, SparseArray):
+            # Match the entries of both tensors by a binary search on the shared values
+            other_key = _select(
+                other.index,
+                other_rank,
+                [other_variables.index(var) for var in var_both],
+            )
+            order = numpy.argsort(other_key, kind="stable")
+            other_key = other_key[order]
+            low = numpy.searchsorted(other_key, key, side="left")
+            counts = numpy.searchsorted(other_key, key, side="right") - low
+            left = numpy.repeat(numpy.arange(len(key)), counts)
+            starts = numpy.cumsum(counts) - counts
+            right = order[numpy.arange(len(left)) - numpy.repeat(starts - low, counts)]
+            right_index = _select(
+                other.index[right],
+                other_rank,
+                [other_variables.index(var) for var in right_only],
+            )
+            values = values[left] * other.values[right]
+        else:
+            # Look up the row of the dense tensor for the shared values of each entry
+            rows = numpy.reshape(
+                numpy.transpose(
+                    other, [other_variables.index(var) for var in var_both + right_only]
+                ),
+                (2 ** len(var_both), 2 ** len(right_only)),
+            )
+            left = numpy.repeat(numpy.arange(len(key)), 2 ** len(right_only))
+            right_index = numpy.tile(
+                numpy.arange(2 ** len(right_only), dtype=numpy.int64), len(key)
+            )
+            values = (values[:, None] * rows[key]).reshape(-1)
+
+        index = _select(
+            self.index[left], rank, [variables.index(var) for var in kept + left_only]
+        )
+        index = (index << len(right_only)) | right_index
+        result_variables = kept + left_only + right_only
+        if len(summed) > 0:
+            return _aggregate(len(result_variables), index, values), result_variables
+        nonzero = values != 0
+        return (
+            SparseArray(len(result_variables), index[nonzero], values[nonzero]),
+            result_variables,
+        )
+
+    def threshold(self):
+        """
+        :return: A sparse array that is 1 at every nonzero entry of this tensor
+        """
+        return SparseArray(len(self.shape), self.index, numpy.ones_like(self.values))
+
+
+def _bits(index, rank, axis):
+    """
+    :return: The value of the provided index at each of the provided flat positions
+    """
+    return (index >> (rank - 1 - axis)) & 1
+
+
+def _select(index, rank, axes):
+    """
+    :return: The flat positions over only the provided indices (in the provided order)
+             that correspond to the provided flat positions
+    """
+    result = numpy.zeros(len(index), dtype=numpy.int64)
+    for axis in axes:
+        result = (result << 1) | _bits(index, rank, axis)
+    return result
+
+
+def _aggregate(rank, index, values):
+    """
+    Sum the values at equal flat positions, and drop the entries that are zero.
+
+    :return: The resulting sparse array
+    """
+    order = numpy.argsort(index, kind="stable")
+    index, values = index[order], values[order]
+    if len(index) > 0:
+        starts = numpy.flatnonzero(numpy.concatenate(([True], index[1:] != index[:-1])))
+        index, values = index[starts], numpy.add.reduceat(values, starts)
+    nonzero = values != 0
+    return SparseArray(rank, index[nonzero], values[nonzero])
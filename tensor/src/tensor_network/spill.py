@@ -0,0 +1,53 @@
+class Spiller:
+    """
+    Move tensors that wait on their parent into memory-mapped files
+    whenever they hold too much memory.
+
+    Spilled tensors are used directly from their files, which the operating system
+    pages back in as they are read.
+    """
+
+    def __init__(self, tensor_library, directory, memory_budget, min_size=2 ** 20):
+        """
+        :param tensor_library: The underlying tensor library
+        :param directory: The scratch directory in which to place spilled tensors
+        :param memory_budget: The memory (bytes) that waiting tensors may hold, together
+                              with the memory held by the tensor library (see held_bytes)
+        :param min_size: Tensors smaller than this (bytes) are never spilled
+        """
+        self._tensor_library = tensor_library
+        self._directory = directory
+        self._memory_budget = memory_budget
+        self._min_size = min_size
+        self.spilled_bytes = 0
+
+    def __call__(self, waiting):
+        """
+        Spill waiting tensors, those waiting longest first, until the rest fit the budget.
+
+        :param waiting: The list of tensors that wait on their parent, oldest first
+        :return: None
+        """
+        in_memory = [
+            tensor
+            for tensor in waiting
+            if tensor is not None
+            and tensor.base is not None
+            and not self._tensor_library.is_spilled(tensor.base)
+        ]
+        held = self._tensor_library.held_bytes + sum(
+            tensor.base.nbytes for tensor in in_memory
+        )
+        if held > self._memory_budget:
+            # Return free buffers to the allocator before spilling any tensor
+            held -= self._tensor_library.drop_buffers(held - self._memory_budget)
+        for tensor in in_memory:
+            if held <= self._memory_budget:
+                break
+            size = tensor.base.nbytes
+            if size < self._min_size:
+                continue
+            tensor.base = self._tensor_library.spill(tensor.base, self._directory)
+            if self._tensor_library.is_spilled(tensor.base):
+                held -= size
+                self.spilled_bytes += size
@@ -1,41 +1,69 @@
+# The largest number of variables of a product that is joined in a single pass
+_MAX_SMALL_JOIN_RANK = 10
+
+
 class Tensor:
-    def __init__(self, base, variables):
+    def __init__(self, base, variables, implicit=None, log_scale=0.0):
+        """
+        :param base: The entries of the tensor, or None if the tensor is implicit
+        :param variables: The variable that corresponds to each index of the tensor
+        :param implicit: If base is None, a tuple (ones, one_hot, index): the tensor is
+                         `ones` at every entry except `index`, where it is `ones - one_hot`
+        :param log_scale: The (base 10) logarithm of a factor of every entry: the tensor
+                          is 10^log_scale times its entries (see rescale)
+
+        A batch of tensors (e.g., one for each of a batch of weights) is stored with an
+        additional final index of base, and with arrays for ones and one_hot.
+        """
         self.base = base
         self.variables = variables
+        self.implicit = implicit
+        self.log_scale = log_scale
 
-    def duplicate_variable(self, tensor_library, var_index):
+    def is_batched(self):
+        if self.base is None:
+            return _is_batched(self.implicit[0]) or _is_batched(self.implicit[1])
+        return len(self.base.shape) > len(self.variables)
+
+    def share(self, tensor_library):
         """
-        Duplicate the provided variable in the tensor.
+        Make the entries of this tensor read-only, so that they can be shared
+        with another tensor (joins then copy the entries before modifying them).
 
-        Note that the duplicated variable is inserted as the first index,
-        so all variables shift forwards by 1.
-        
         :param tensor_library: The underlying tensor library
-        :param var_index: The index of the variable to duplicate
-        :return: The location of the new variable (0)
+        :return: A new tensor with the same entries
         """
-        if len(self.variables) == 30:
-            raise RuntimeError("Requires tensor rank above 30")
+        if self.base is not None:
+            self.base = tensor_library.read_only(self.base)
+        return Tensor(self.base, list(self.variables), self.implicit, self.log_scale)
 
-        self.base = tensor_library.stack([self.base, self.base], axis=0)
-        self.variables.insert(0, self.variables[var_index])
+    def materialize(self, tensor_library):
+        """
+        Build the entries of this tensor, if it is implicit.
 
-        lookup = [slice(0, 2) for _ in self.base.shape]
-        lookup[0] = 0
-        lookup[var_index + 1] = 1
-        self.base[tuple(lookup)] = 0
+        The entries may be shared with other tensors and so must not be modified in place.
 
-        lookup[0] = 1
-        lookup[var_index + 1] = 0
-        self.base[tuple(lookup)] = 0
+        :param tensor_library: The underlying tensor library
+        :return: None
+        """
+        if self.base is not None:
+            return
+        if len(self.variables) > 30:
+            raise RuntimeError("Requires tensor rank above 30")
 
-        return 0
+        ones, one_hot, index = self.implicit
+        self.base = tensor_library.create_clause_tensor(index, ones, one_hot)
+        self.implicit = None
 
     def join_with(self, tensor_library, other, projected_weights):
         """
         Take the product of this tensor with the provided tensor,
         then project out all specified variables.
 
+        Variables that appear in both tensors but are not projected are treated as
+        hyperedges: both tensors are viewed as a batch of matrices indexed by these
+        variables, so that the join is a single batched matrix product.
+
         The result is stored in this tensor.
 
         :param tensor_library: The underlying tensor library
@@ -43,48 +71,417 @@ class Tensor:
         :param projected_weights: The variables to project out, mapped to their weights
         :return: None
         """
+        self.log_scale += other.log_scale
+        if self._join_small(tensor_library, other, projected_weights):
+            return
 
-        # Duplicate the variables that appear in both (but are not projected out)
-        var_both = [var for var in self.variables if var in other.variables]
-        for var in reversed(var_both):
-            if var in projected_weights:
-                # Include the weights of the projected variables
-                var_index = self.variables.index(var)
-                lookup = [slice(0, 2) for _ in self.base.shape]
-                lookup[var_index] = 0
-                self.base[tuple(lookup)] *= projected_weights[var][0]
-                lookup[var_index] = 1
-                self.base[tuple(lookup)] *= projected_weights[var][1]
-
-                del projected_weights[var]  # Projection will be done by tensordot
-                continue  # no need to duplicate
-            elif len(self.variables) <= len(other.variables):
-                self.duplicate_variable(tensor_library, self.variables.index(var))
+        # Project the variables that appear in only one tensor before the product
+        self.project_out(
+            tensor_library,
+            {
+                var: weights
+                for var, weights in projected_weights.items()
+                if var in self.variables and var not in other.variables
+            },
+        )
+        other.project_out(
+            tensor_library,
+            {
+                var: weights
+                for var, weights in projected_weights.items()
+                if var in other.variables and var not in self.variables
+            },
+        )
+        summed_weights = {
+            var: projected_weights[var]
+            for var in self.variables
+            if var in other.variables and var in projected_weights
+        }
+
+        if tensor_library.semiring.maximizes:
+            self._join_maximizing(tensor_library, other, summed_weights)
+            return
+
+        if tensor_library.is_sparse(self.base) or tensor_library.is_sparse(other.base):
+            if (
+                self.is_batched()
+                or other.is_batched()
+                or any(_is_batched(w) for ws in summed_weights.values() for w in ws)
+            ):
+                self.base = tensor_library.to_dense(self.base)
+                other.base = tensor_library.to_dense(other.base)
+            else:
+                self._join_sparse(tensor_library, other, summed_weights)
+                return
+
+        # At most one of the tensors may remain implicit, and none if batched
+        if (
+            self.is_batched()
+            or other.is_batched()
+            or any(_is_batched(w) for ws in summed_weights.values() for w in ws)
+        ):
+            self.materialize(tensor_library)
+            other.materialize(tensor_library)
+        elif self.base is None and other.base is None:
+            if len(self.variables) <= len(other.variables):
+                self.materialize(tensor_library)
             else:
-                other.duplicate_variable(tensor_library, other.variables.index(var))
+                other.materialize(tensor_library)
+
+        if self.base is None:
+            self.base, self.variables = Tensor._join_implicit(
+                tensor_library,
+                other.base,
+                other.variables,
+                self.implicit,
+                self.variables,
+                summed_weights,
+            )
+            self.implicit = None
+        elif other.base is None:
+            self.base, self.variables = Tensor._join_implicit(
+                tensor_library,
+                self.base,
+                self.variables,
+                other.implicit,
+                other.variables,
+                summed_weights,
+            )
+        else:
+            self._join_dense(tensor_library, other, summed_weights)
+
+    def _join_small(self, tensor_library, other, projected_weights):
+        """
+        Take the product of this tensor with the provided tensor and project out the
+        specified variables in a single pass, if the product has at most
+        _MAX_SMALL_JOIN_RANK variables (so that its layout as a matrix product, and the
+        implicit product of clause tensors, cost more than they save).
+
+        :return: True if the tensors were joined, or False if they must be joined
+                 otherwise (they may then have been materialized)
+        """
+        variables = self.variables + [
+            var for var in other.variables if var not in self.variables
+        ]
+        if (
+            len(variables) > _MAX_SMALL_JOIN_RANK
+            or tensor_library.semiring.maximizes
+            or self.is_batched()
+            or other.is_batched()
+            or any(_is_batched(w) for ws in projected_weights.values() for w in ws)
+            or (self.base is not None and tensor_library.is_sparse(self.base))
+            or (other.base is not None and tensor_library.is_sparse(other.base))
+        ):
+            return False
+
+        label = {var: i for i, var in enumerate(variables)}
+        kept = [var for var in variables if var not in projected_weights]
+        self.materialize(tensor_library)
+        other.materialize(tensor_library)
+        result = tensor_library.join_small(
+            self.base,
+            [label[var] for var in self.variables],
+            other.base,
+            [label[var] for var in other.variables],
+            {
+                label[var]: weights
+                for var, weights in projected_weights.items()
+                if var in label
+            },
+            [label[var] for var in kept],
+        )
+        if result is None:
+            return False
+        tensor_library.release(self.base)
+        tensor_library.release(other.base)
+        self.base = result
+        self.variables = kept
+        return True
+
+    def _join_dense(self, tensor_library, other, summed_weights):
+        """
+        Take the product of this tensor with the provided tensor, where both are dense,
+        then project out the provided variables (which must appear in both).
+
+        The batch index of batched tensors is an additional leading batch dimension of
+        the matrix product, which broadcasts over unbatched tensors.
+        """
+        var_both = [var for var in self.variables if var in other.variables]
+        summed = [var for var in var_both if var in summed_weights]
+        kept = [var for var in var_both if var not in summed_weights]
+        left_only = [var for var in self.variables if var not in other.variables]
+        right_only = [var for var in other.variables if var not in self.variables]
 
         # Compute the resulting tensor
-        if len(self.base.shape) + len(other.base.shape) - 2 * len(var_both) > 30:
+        if len(kept) + len(left_only) + len(right_only) > 30:
             raise RuntimeError("Requires tensor rank above 30")
 
-        left_summed = [self.variables.index(var) for var in var_both]
-        right_summed = [other.variables.index(var) for var in var_both]
-        self.base = tensor_library.tensordot(
-            self.base, other.base, (left_summed, right_summed)
+        # Order the variables of both tensors so that the matrix views need no copy
+        naive = {"left": (kept, left_only, summed), "right": (kept, summed, right_only)}
+        kept = Tensor._choose_layout(kept, self.variables, other.variables)
+        summed = Tensor._choose_layout(summed, self.variables, other.variables)
+        layouts = {
+            "left": (kept, left_only, summed),
+            "right": (kept, summed, right_only),
+        }
+
+        # Include the weights of the projected variables (weights of 1 are skipped)
+        weighted = [
+            var
+            for var in summed
+            if _is_batched(summed_weights[var][0])
+            or _is_batched(summed_weights[var][1])
+            or summed_weights[var][0] != 1
+            or summed_weights[var][1] != 1
+        ]
+        if any(_is_batched(w) for var in weighted for w in summed_weights[var]):
+            for var in weighted:
+                slices = self._weighted_slices(tensor_library, var, summed_weights[var])
+                self.base = tensor_library.stack(slices, axis=self.variables.index(var))
+        elif len(weighted) > 0:
+            # Multiply all weights into the smaller tensor, in one pass
+            weighted_tensor = self if self.base.size <= other.base.size else other
+            unweighted = weighted_tensor.base
+            weighted_tensor.base = tensor_library.reduce(
+                unweighted
+                * tensor_library.broadcast_weights(
+                    len(unweighted.shape),
+                    [weighted_tensor.variables.index(var) for var in weighted],
+                    [summed_weights[var] for var in weighted],
+                )
+            )
+            tensor_library.release(unweighted)
+
+        copied, saved = 0, 0
+        views = {}
+        for side, tensor in (("left", self), ("right", other)):
+            views[side] = Tensor._matrix_view(
+                tensor_library, tensor.base, tensor.variables, *layouts[side]
+            )
+            if not tensor_library.is_view_of(views[side], tensor.base):
+                copied += tensor.base.nbytes
+            elif not Tensor._is_contiguous(tensor.variables, naive[side]):
+                saved += tensor.base.nbytes
+        tensor_library.count_transposes(copied, saved)
+
+        result = tensor_library.matmul(views["left"], views["right"])
+        tensor_library.release(self.base)
+        tensor_library.release(other.base)
+        num_variables = len(kept) + len(left_only) + len(right_only)
+        if self.is_batched() or other.is_batched():
+            # Move the batch index back to the end
+            result = tensor_library.reshape(
+                result, [result.shape[0]] + [2 for _ in range(num_variables)]
+            )
+            self.base = tensor_library.transpose(
+                result, list(range(1, num_variables + 1)) + [0]
+            )
+        else:
+            self.base = tensor_library.reshape(
+                result, [2 for _ in range(num_variables)]
+            )
+        self.variables = kept + left_only + right_only
+
+    def _join_sparse(self, tensor_library, other, summed_weights):
+        """
+        Take the product of this tensor with the provided tensor, where at least one is
+        sparse, then project out the provided variables (which must appear in both).
+
+        The result is sparse; the other tensor is used as is if it is dense.
+        """
+        self.materialize(tensor_library)
+        other.materialize(tensor_library)
+        if tensor_library.is_sparse(self.base):
+            self.base, self.variables = self.base.join(
+                self.variables, other.base, other.variables, summed_weights
+            )
+        else:
+            self.base, self.variables = other.base.join(
+                other.variables, self.base, self.variables, summed_weights
+            )
+
+    def _join_maximizing(self, tensor_library, other, summed_weights):
+        """
+        Take the product of this tensor with the provided tensor in a maximizing
+        semiring, then project out the provided variables (which must appear in both).
+
+        Both tensors are broadcast over all of their variables, since the projection
+        cannot be folded into a matrix product.
+        """
+        self.materialize(tensor_library)
+        other.materialize(tensor_library)
+        variables = self.variables + [
+            var for var in other.variables if var not in self.variables
+        ]
+        if len(variables) > 30:
+            raise RuntimeError("Requires tensor rank above 30")
+
+        left = tensor_library.reshape(
+            self.base, [2 if var in self.variables else 1 for var in variables]
+        )
+        right = tensor_library.reshape(
+            tensor_library.transpose(
+                other.base,
+                [
+                    other.variables.index(var)
+                    for var in variables
+                    if var in other.variables
+                ],
+            ),
+            [2 if var in other.variables else 1 for var in variables],
+        )
+        self.base = tensor_library.semiring.multiply(left, right)
+        self.variables = variables
+        self.project_out(tensor_library, summed_weights)
+
+    @staticmethod
+    def _choose_layout(group, variables, other_variables):
+        """
+        Order a group of variables of both tensors, as the variables of the tensor with
+        more variables (or else of the other tensor) if they are consecutive there.
+        The group is then a single index of that matrix view, without a copy.
+
+        :return: The ordered group
+        """
+        candidates = [variables, other_variables]
+        if len(other_variables) > len(variables):
+            candidates.reverse()
+        for candidate in candidates:
+            order = sorted(group, key=candidate.index)
+            if Tensor._is_contiguous(candidate, [order]):
+                return order
+        return sorted(group, key=candidates[0].index)
+
+    @staticmethod
+    def _is_contiguous(variables, groups):
+        """
+        :return: True if the variables of each group are consecutive and in order among
+                 the provided variables, so that a (C-contiguous) tensor can be viewed
+                 with an index for each group without a copy
+        """
+        position = {var: i for i, var in enumerate(variables)}
+        return all(
+            position[b] == position[a] + 1
+            for group in groups
+            for a, b in zip(group, group[1:])
         )
 
-        # Determine the variables of the new tensor
-        self.variables = [
-            var for j, var in enumerate(self.variables) if j not in left_summed
-        ] + [var for j, var in enumerate(other.variables) if j not in right_summed]
+    @staticmethod
+    def _matrix_view(tensor_library, base, variables, batch, rows, columns):
+        """
+        View the entries of a tensor as a batch of matrices, indexed by the provided
+        groups of variables. The batch index of a batched tensor is placed first.
+        """
+        axes = [variables.index(var) for var in batch + rows + columns]
+        shape = [2 ** len(batch), 2 ** len(rows), 2 ** len(columns)]
+        if len(base.shape) > len(variables):
+            axes = [len(variables)] + axes
+            shape = [base.shape[-1]] + shape
+        return tensor_library.reshape(tensor_library.transpose(base, axes), shape)
 
-        # Project remaining variables
-        self.project_out(tensor_library, projected_weights)
+    def _weighted_slices(self, tensor_library, var, weights):
+        """
+        Split this dense tensor on the value of the provided variable, and multiply each
+        slice by the weight of that value. If either the weights or this tensor are
+        batched, both slices are batched.
+
+        :return: The pair of weighted slices
+        """
+        var_index = self.variables.index(var)
+        lookup = [slice(0, 2) for _ in self.variables]
+        slices = []
+        for value in (0, 1):
+            lookup[var_index] = value
+            entries = self.base[tuple(lookup) + (Ellipsis,)]
+            if not self.is_batched():
+                entries = entries[..., None]
+            slices.append(tensor_library.reduce(entries * weights[value]))
+        return slices
+
+    @staticmethod
+    def _join_implicit(
+        tensor_library, base, variables, implicit, implicit_variables, summed_weights
+    ):
+        """
+        Take the product of a dense tensor with an implicit tensor,
+        then project out the provided variables (which must appear in both).
+
+        The product is `ones` times the dense tensor, broadcast over the variables
+        of the implicit tensor, minus `one_hot` times a single slice of the dense tensor.
+        The dense tensor keeps its layout: the variables of the result are its remaining
+        variables, followed by those of only the implicit tensor.
+
+        :return: The entries and variables of the resulting dense tensor
+        """
+        ones, one_hot, index = implicit
+        falsifying = dict(zip(implicit_variables, index))
+        kept = [v for v in variables if v in falsifying and v not in summed_weights]
+        dense_only = [v for v in variables if v not in falsifying]
+        implicit_only = [v for v in implicit_variables if v not in variables]
+
+        if len(kept) + len(dense_only) + len(implicit_only) > 30:
+            raise RuntimeError("Requires tensor rank above 30")
+
+        # The slice of the dense tensor that meets the one-hot entry
+        scale = one_hot
+        for var in summed_weights:
+            scale = tensor_library.reduce(scale * summed_weights[var][falsifying[var]])
+        lookup = tuple(falsifying.get(var, slice(0, 2)) for var in variables)
+        one_hot_slice = tensor_library.reduce(base[lookup + (Ellipsis,)] * scale)
+
+        # The dense tensor with all summed variables projected out
+        projected = Tensor(base, list(variables))
+        projected.project_out(tensor_library, summed_weights)
+        if not Tensor._is_contiguous(projected.variables, [kept, dense_only]):
+            # Moving the kept variables first would have copied the tensor
+            tensor_library.count_transposes(0, projected.base.nbytes)
+        projected_size = 2 ** len(projected.variables)
+
+        # Broadcast over the remaining variables of the implicit tensor
+        result = tensor_library.matmul(
+            tensor_library.reshape(projected.base, (projected_size, 1)),
+            tensor_library.create_tensor([1, 2 ** len(implicit_only)], ones),
+        )
+        tensor_library.release(projected.base)
+        result = tensor_library.reshape(
+            result, [2 for _ in range(len(projected.variables) + len(implicit_only))]
+        )
+        lookup = tuple(falsifying.get(var, slice(0, 2)) for var in projected.variables)
+        lookup += tuple(falsifying[var] for var in implicit_only)
+        result[lookup] = tensor_library.reduce(result[lookup] - one_hot_slice)
+        return result, projected.variables + implicit_only
+
+    def condition(self, assignment):
+        """
+        Restrict this tensor to the provided values of some variables,
+        which are then removed from the tensor.
+
+        :param assignment: A dictionary mapping variables to their value (0 or 1)
+        :return: None
+        """
+        if self.base is None:
+            ones, one_hot, index = self.implicit
+            for var, value in zip(self.variables, index):
+                if var in assignment and assignment[var] != value:
+                    one_hot = 0  # The entry `index` is no longer present
+            index = tuple(
+                value
+                for var, value in zip(self.variables, index)
+                if var not in assignment
+            )
+            self.implicit = (ones, one_hot, index)
+        else:
+            lookup = tuple(
+                assignment[var] if var in assignment else slice(0, 2)
+                for var in self.variables
+            )
+            self.base = self.base[lookup + (Ellipsis,)]
+        self.variables = [var for var in self.variables if var not in assignment]
 
     def project_out(self, tensor_library, projected_weights):
         """
         Project out the provided variables.
-        
+
         :param tensor_library: The underlying tensor library
         :param projected_weights: The variables to project out, mapped to their weights
         :return: None
@@ -92,30 +489,191 @@ class Tensor:
         if len(projected_weights) == 0:
             return
 
+        semiring = tensor_library.semiring
+        if semiring.maximizes:
+            # Take the maximum of the weighted slices of each variable in turn
+            self.materialize(tensor_library)
+            for var in projected_weights:
+                var_index = self.variables.index(var)
+                lookup = [slice(0, 2) for _ in self.variables]
+                slices = []
+                for value in (0, 1):
+                    lookup[var_index] = value
+                    slices.append(
+                        semiring.multiply(
+                            self.base[tuple(lookup)], projected_weights[var][value]
+                        )
+                    )
+                self.base = semiring.add(tensor_library, *slices)
+                del self.variables[var_index]
+            return
+
+        if self.base is None:
+            # Every entry of the sum is `ones` except the one that includes `index`
+            ones, one_hot, index = self.implicit
+            for var in projected_weights:
+                var_index = self.variables.index(var)
+                ones = tensor_library.reduce(
+                    ones * (projected_weights[var][0] + projected_weights[var][1])
+                )
+                one_hot = tensor_library.reduce(
+                    one_hot * projected_weights[var][index[var_index]]
+                )
+                index = index[:var_index] + index[var_index + 1 :]
+                del self.variables[var_index]
+            self.implicit = (ones, one_hot, index)
+            return
+
+        if tensor_library.is_sparse(self.base) and any(
+            _is_batched(w) for ws in projected_weights.values() for w in ws
+        ):
+            self.base = tensor_library.to_dense(self.base)
+
+        if not self.is_batched() and not any(
+            _is_batched(w) for ws in projected_weights.values() for w in ws
+        ):
+            # Weight and sum out all variables at once
+            unprojected = self.base
+            self.base = tensor_library.project(
+                unprojected,
+                [self.variables.index(var) for var in projected_weights],
+                list(projected_weights.values()),
+            )
+            tensor_library.release(unprojected)
+            self.variables = [v for v in self.variables if v not in projected_weights]
+            return
+
         for var in projected_weights:
-            self.base = tensor_library.tensordot(
-                self.base, projected_weights[var], ([self.variables.index(var), 0])
+            neg, pos = self._weighted_slices(
+                tensor_library, var, projected_weights[var]
             )
+            self.base = tensor_library.reduce(neg + pos)
             self.variables.remove(var)
 
+    def threshold(self, tensor_library):
+        """
+        Replace every nonzero entry of this tensor by 1. After a sum over some variables,
+        this projects the variables existentially.
+
+        :param tensor_library: The underlying tensor library
+        :return: None
+        """
+        if self.base is None and not self.is_batched():
+            ones, one_hot, index = self.implicit
+            ones, rest = (1 if value != 0 else 0 for value in (ones, ones - one_hot))
+            self.implicit = (ones, ones - rest, index)
+        else:
+            self.materialize(tensor_library)
+            self.base = tensor_library.threshold(self.base)
+        self.log_scale = 0.0
+
+    def rescale(self, tensor_library):
+        """
+        Divide the entries of this tensor by their largest magnitude, whose logarithm is
+        added to log_scale. The entries then neither underflow nor overflow through many
+        joins, even with float32 or float16 entries.
+
+        :param tensor_library: The underlying tensor library
+        :return: None
+        """
+        if self.base is not None and not self.is_batched():
+            self.base, log_magnitude = tensor_library.normalize(self.base)
+            self.log_scale += log_magnitude
+
+    def compact(self, tensor_library):
+        """
+        Store the entries of this tensor in the representation that the tensor library
+        chooses for their density (e.g., sparsely if they are mostly zero).
+
+        :param tensor_library: The underlying tensor library
+        :return: None
+        """
+        if self.base is not None and not self.is_batched():
+            self.base = tensor_library.compact(self.base)
+
     @staticmethod
     def from_clause(tensor_library, clause):
-        # Compute the resulting tensor
-        if len(clause) > 30:
-            raise RuntimeError("Requires tensor rank above 30")
+        """
+        Construct the implicit tensor for a clause, which is the one of the semiring
+        at every entry except the one that falsifies the clause (which is its zero).
 
+        :param tensor_library: The underlying tensor library
+        :param clause: The literals of the clause
+        :return: The implicit tensor
+        """
         # Record the variable that corresponds to each tensor index, with no repeated variables
         variables = list({abs(lit) for lit in clause})
+        # Index 1 of a variable is true, so the clause is falsified where each positive
+        # literal is 0 and each negative literal is 1
+        index = tuple(0 if var in clause else 1 for var in variables)
 
-        # Build the tensor for this clause
-        base = tensor_library.create_tensor([2 for _ in variables], 1)
+        # The falsifying entry is the zero of the semiring, and all others are its one
+        one = tensor_library.semiring.one
+        one_hot = one - tensor_library.semiring.zero
 
         # If a variable and its negation appear in a clause, the clause is trivial
         if len(variables) != len(clause):
             for var in variables:
                 if var in clause and -var in clause:
-                    return Tensor(base, variables)
+                    return Tensor(None, variables, implicit=(one, 0, index))
 
-        base[tuple(1 if var in clause else 0 for var in variables)] = 0
+        return Tensor(None, variables, implicit=(one, one_hot, index))
 
+    @staticmethod
+    def from_xor_clause(tensor_library, clause, assignment=None):
+        """
+        Construct the (dense) parity tensor for an XOR clause, which is the one of the
+        semiring at every entry that satisfies the clause (see xor_parity) and its zero
+        elsewhere.
+
+        :param tensor_library: The underlying tensor library
+        :param clause: The literals of the clause
+        :param assignment: Variables that are fixed to a value (0 or 1), and so do not
+                           appear in the tensor
+        :return: The dense tensor
+        """
+        parity, target = Tensor.xor_parity(clause, assignment)
+        variables = list(parity)
+        if len(variables) > 30:
+            raise RuntimeError("Requires tensor rank above 30")
+        base = tensor_library.create_parity_tensor(
+            tuple(parity[var] for var in variables),
+            target,
+            tensor_library.semiring.one,
+            tensor_library.semiring.zero,
+        )
         return Tensor(base, variables)
+
+    @staticmethod
+    def xor_parity(clause, assignment=None):
+        """
+        Write an XOR clause as a parity constraint: the XOR of the variables marked 1
+        must be the target. Variables that appear an even number of times are marked 0,
+        since they do not affect the parity.
+
+        As in from_clause, a positive literal is satisfied at index 1 of its variable.
+
+        :param clause: The literals of the clause
+        :param assignment: Variables that are fixed to a value (0 or 1), and so are
+                           folded into the target
+        :return: A dictionary of the mark of each unassigned variable, and the target
+        """
+        if assignment is None:
+            assignment = {}
+
+        target = 1
+        parity = {}
+        for lit in clause:
+            target ^= 1 if lit < 0 else 0
+            if abs(lit) in assignment:
+                target ^= assignment[abs(lit)]
+            else:
+                parity[abs(lit)] = parity.get(abs(lit), 0) ^ 1
+        return parity, target
+
+
+def _is_batched(value):
+    """
+    Returns true if the provided weight or scalar is an array of a batch of values.
+    """
+    return len(getattr(value, "shape", ())) > 0
@@ -1,36 +1,456 @@
+import collections
+import contextlib
+import threading
+import weakref
+
+from tensor_network.semiring import SumProduct
+from tensor_network.sparse import SparseArray
+
+
 class NumpyAPI:
-    def __init__(self, entry_type, thread_limit=None):
+    def __init__(
+        self,
+        entry_type,
+        thread_limit=None,
+        max_cached_rank=20,
+        modulus=None,
+        semiring=None,
+        buffer_budget=2 ** 27,
+        shared_budget=2 ** 26,
+    ):
+        """
+        :param entry_type: The data type of all tensor entries
+        :param thread_limit: The number of threads to limit tensor manipulations (in
+                             total, see limit_threads)
+        :param max_cached_rank: The largest rank of clause tensors to share between calls
+        :param modulus: If given, all arithmetic is performed modulo this prime (which must
+                        be below 2^31), and entries are always reduced. Use with the "exact"
+                        entry type.
+        :param semiring: The semiring in which tensors are joined and variables are
+                         projected (default is sum-product)
+        :param buffer_budget: The memory (bytes) that buffers of released tensors may
+                              hold until they are reused (see release)
+        :param shared_budget: The memory (bytes) that clause and parity tensors shared
+                              between calls may hold (the least recently used are evicted)
+        """
+        self.semiring = SumProduct() if semiring is None else semiring
         self._thread_limit = thread_limit
-        if thread_limit is not None:
-            import threadpoolctl
-
-            self._thread_limiter = threadpoolctl
+        self._max_cached_rank = max_cached_rank
+        self._modulus = modulus
+        self._shared = _SharedTensors(shared_budget)
+        self._transpose_lock = threading.Lock()
+        self.transpose_counts = {"copied": 0, "saved": 0}
 
         import numpy
 
         self._numpy = numpy
         self._entry_type = self._get_numpy_type(entry_type)
+        self._buffers = _BufferPool(numpy, buffer_budget)
+        if modulus is not None:
+            # The number of products of residues that can be summed without overflow
+            self._max_summed = (2 ** 63 - 1) // (modulus - 1) ** 2
+
+    def with_modulus(self, modulus):
+        """
+        :return: A tensor library of exact int64 arithmetic modulo the provided prime
+        """
+        library = NumpyAPI(
+            "exact",
+            thread_limit=self._thread_limit,
+            max_cached_rank=self._max_cached_rank,
+            modulus=modulus,
+        )
+        # Count the transposes of both libraries together, and share their buffers
+        library._transpose_lock = self._transpose_lock
+        library.transpose_counts = self.transpose_counts
+        library._buffers = self._buffers
+        library._shared = self._shared
+        return library
+
+    def limit_threads(self, workers=1):
+        """
+        Limit tensor manipulations to thread_limit threads in total, split between the
+        provided number of workers that manipulate tensors at once (inter-op) and the
+        threads of each manipulation (intra-op).
+
+        BLAS has a single limit for the whole process, so jobs that run at once (e.g. in
+        a server) share it: see _BlasLimits.
+
+        :param workers: The number of threads that manipulate tensors at once
+        :return: A context manager within which the limit applies
+        """
+        if self._thread_limit is None:
+            return contextlib.nullcontext()
+        return _BLAS_LIMITS.limit(max(1, self._thread_limit // workers))
+
+    def reduce(self, a):
+        """
+        Reduce the provided tensor or scalar modulo the modulus, if there is one.
+        """
+        if self._modulus is None:
+            return a
+        return a % self._modulus
 
     def create_tensor(self, shape, default_value=None):
-        if default_value is None:
-            return self._numpy.empty(shape, dtype=self._entry_type)
+        result = self._buffers.take(shape, self._entry_type)
+        if default_value is not None:
+            result[...] = default_value
+        return result
+
+    def release(self, a):
+        """
+        Release a tensor that is no longer used, so that its buffer can be reused for a
+        later tensor of the same size. Only writeable tensors whose buffer was taken
+        from the pool are released; tensors that were shared (see read_only) are not.
+        """
+        self._buffers.give(a)
+
+    @property
+    def held_bytes(self):
+        """
+        :return: The memory (bytes) that the library holds outside of tensors in use
+                 (the clause and parity tensors shared between calls, and the free
+                 buffers of released tensors), which counts against the memory budgets
+                 of execution
+        """
+        return self._shared.held + self._buffers.held
+
+    def drop_buffers(self, size):
+        """
+        Return free buffers of released tensors to the allocator, until they hold the
+        provided memory (bytes) less, or none are left.
+
+        :return: The memory (bytes) of the dropped buffers
+        """
+        return self._buffers.drop(size)
+
+    @property
+    def buffer_counts(self):
+        """
+        :return: The number of buffers allocated and reused, and the bytes reused
+        """
+        return self._buffers.counts
+
+    def create_clause_tensor(self, index, ones, one_hot):
+        """
+        Create a tensor that is `ones` at every entry except `index`,
+        where it is `ones - one_hot`.
+
+        Tensors of clauses (i.e., where ones is 1 and one_hot is 0 or 1) are cached by
+        their arity and sign pattern and shared between calls (within the shared budget),
+        so they are read-only.
+
+        If ones or one_hot are arrays of a batch of values, the result has an additional
+        final index over the batch.
+        """
+        batch = self._numpy.broadcast(ones, one_hot).shape
+        if len(batch) > 0:
+            result = self.create_tensor([2 for _ in index] + list(batch), ones)
+            result[index] = self.reduce(ones - one_hot)
+            return result
+
+        key = ("clause", self._entry_type, self._modulus, index, ones, one_hot)
+        result = self._shared.get(key)
+        if result is not None:
+            return result
+
+        result = self.create_tensor([2 for _ in index], ones)
+        result[index] = self.reduce(ones - one_hot)
+        if len(index) <= self._max_cached_rank and ones == 1 and one_hot in (0, 1):
+            result.flags.writeable = False
+            self._shared.put(key, result)
+        return result
+
+    def create_parity_tensor(self, parity, target, one, zero):
+        """
+        Create a tensor that is `one` at every entry where the exclusive or of the indices
+        marked by `parity` is `target`, and `zero` elsewhere.
+
+        Small tensors are cached and shared between calls (within the shared budget),
+        so they are read-only.
+        """
+        key = ("parity", self._entry_type, self._modulus, parity, target, one, zero)
+        result = self._shared.get(key)
+        if result is not None:
+            return result
+
+        values = self._numpy.zeros([1 for _ in parity], dtype=self._numpy.uint8)
+        index = self._numpy.arange(2, dtype=self._numpy.uint8)
+        for i, marked in enumerate(parity):
+            if marked:
+                shape = [1 for _ in parity]
+                shape[i] = 2
+                values = values ^ index.reshape(shape)
+        values = self._numpy.broadcast_to(values, [2 for _ in parity])
+        result = self._numpy.where(values == target, one, zero).astype(self._entry_type)
+        result = self.reduce(result)
+        if len(parity) <= self._max_cached_rank:
+            result.flags.writeable = False
+            self._shared.put(key, result)
+        return result
+
+    def fwht(self, a):
+        """
+        :return: The (unnormalized) Walsh-Hadamard transform of the provided tensor over
+                 every index, by one butterfly pass per index
+        """
+        for axis in range(len(a.shape)):
+            lookup = [slice(0, 2) for _ in a.shape]
+            lookup[axis] = 0
+            low = a[tuple(lookup)]
+            lookup[axis] = 1
+            high = a[tuple(lookup)]
+            a = self._numpy.stack([low + high, low - high], axis=axis)
+        return a
+
+    def xor_spectrum(self, parity, targets, weights, num_outputs):
+        """
+        Sum the terms of a system of XOR constraints in the Hadamard domain, one term for
+        each assignment y of a bit to each constraint.
+
+        :param parity: A 0/1 matrix with a row for each constraint and a column for each
+                       variable (first the summed variables, then num_outputs others),
+                       marking the variables whose XOR is constrained
+        :param targets: The value of the XOR of each constraint
+        :param weights: The transformed weights (w0 + w1, w0 - w1) of each summed variable
+        :param num_outputs: The number of other variables
+        :return: A tensor over the other variables, whose entry s is the sum over all y
+                 with (y parity) = s on the other variables of (-1)^(y targets) times the
+                 transformed weight of each summed variable v at (y parity)_v
+        """
+        numpy = self._numpy
+        parity = numpy.asarray(parity, dtype=numpy.int64).reshape(len(targets), -1)
+        targets = numpy.asarray(targets, dtype=numpy.int64)
+        place = 2 ** numpy.arange(num_outputs - 1, -1, -1, dtype=numpy.int64)
+        shifts = numpy.arange(len(targets) - 1, -1, -1, dtype=numpy.int64)
+
+        result = numpy.zeros(2 ** num_outputs, dtype=self._entry_type)
+        for start in range(0, 2 ** len(targets), 2 ** 16):
+            y = numpy.arange(start, min(start + 2 ** 16, 2 ** len(targets)))
+            bits = (y[:, None] >> shifts) & 1
+            columns = bits @ parity % 2
+            terms = (1 - 2 * (bits @ targets % 2)).astype(self._entry_type)
+            for var, (even, odd) in enumerate(weights):
+                terms = terms * numpy.where(columns[:, var] == 1, odd, even)
+            index = columns[:, len(weights) :] @ place
+            result += numpy.bincount(index, weights=terms, minlength=len(result))
+        return result.reshape([2 for _ in range(num_outputs)])
+
+    def normalize(self, a):
+        """
+        Divide the provided tensor by the largest magnitude of its entries.
+
+        :return: The divided tensor, and the (base 10) logarithm of the magnitude (the
+                 tensor is returned as is if every entry is zero)
+        """
+        largest = self._numpy.max(self._numpy.abs(a))
+        if largest == 0 or not self._numpy.isfinite(largest):
+            return a, 0.0
+        return a / largest, float(self._numpy.log10(float(largest)))
+
+    def is_sparse(self, a):
+        """
+        :return: True if the provided tensor is stored sparsely (see SparseAPI)
+        """
+        return False
+
+    def to_dense(self, a):
+        return a
+
+    def compact(self, a):
+        """
+        :return: The provided tensor, stored in the representation that suits the
+                 density of its entries
+        """
+        return a
+
+    def broadcast_weights(self, rank, axes, weights):
+        """
+        :param rank: The rank of the tensors to broadcast against
+        :param axes: The indices that are weighted
+        :param weights: The pair of weights of each index
+        :return: A tensor that broadcasts against tensors of the provided rank, whose
+                 entries are the product of the weights of the values of the indices
+        """
+        result = self.create_tensor([1 for _ in range(rank)], 1)
+        for axis, pair in zip(axes, weights):
+            shape = [1 for _ in range(rank)]
+            shape[axis] = 2
+            pair = self._numpy.asarray(pair, dtype=self._entry_type)
+            result = self.reduce(result * self._numpy.reshape(pair, shape))
+        return result
+
+    def project(self, a, axes, weights):
+        """
+        Sum out the provided indices of the tensor, weighting the entries at each value
+        of an index by the weight of that value.
+
+        All indices are summed in one pass over the tensor: by a product with the
+        weights of all their values if they are consecutive, and by einsum otherwise.
+
+        :param a: The tensor
+        :param axes: The indices to sum out
+        :param weights: The pair of weights of each index
+        :return: The resulting tensor
+        """
+        if self._modulus is not None or self._numpy.dtype(self._entry_type).hasobject:
+            # Reduce after each index, so that sums of residues do not overflow
+            for axis, pair in sorted(zip(axes, weights), reverse=True):
+                a = self.tensordot(a, pair, ([axis, 0]))
+            return a
+
+        numpy = self._numpy
+        order = sorted(range(len(axes)), key=lambda i: axes[i])
+        axes = [axes[i] for i in order]
+        weight = self.broadcast_weights(
+            len(axes), range(len(axes)), [weights[i] for i in order]
+        )
+        kept = [axis for axis in range(len(a.shape)) if axis not in axes]
+        if axes == list(range(axes[0], axes[0] + len(axes))):
+            matrices = numpy.reshape(
+                a, (2 ** axes[0], 2 ** len(axes), 2 ** (len(a.shape) - axes[-1] - 1))
+            )
+            result = self.matmul(numpy.reshape(weight, (1, -1)), matrices)
+            return numpy.reshape(result, [2 for _ in kept])
+        result = self._buffers.take([2 for _ in kept], numpy.result_type(a, weight))
+        return numpy.einsum(
+            a, list(range(len(a.shape))), weight, axes, kept, out=result
+        )
+
+    def ensure_writeable(self, a):
+        if a.flags.writeable:
+            return a
         else:
-            return self._numpy.full(shape, default_value, dtype=self._entry_type)
+            return a.copy()
+
+    def read_only(self, a):
+        if not a.flags.writeable:
+            return a
+        result = a.view()
+        result.flags.writeable = False
+        return result
+
+    def threshold(self, a):
+        """
+        :return: A tensor that is 1 at every nonzero entry of the provided tensor,
+                 and 0 elsewhere
+        """
+        return self._numpy.where(a != 0, 1, 0).astype(self._entry_type)
+
+    def maximum(self, a, b):
+        return self._numpy.maximum(a, b)
+
+    def argmax(self, a):
+        """
+        :return: The position of a maximum entry of the provided tensor, as a flat index
+        """
+        return int(self._numpy.argmax(a))
 
     def stack(self, array, **kwargs):
         return self._numpy.stack(array, **kwargs)
 
     def tensordot(self, a, b, axes):
-        return self._numpy.tensordot(a, b, axes)
+        return self.reduce(self._numpy.tensordot(a, b, axes))
+
+    def join_small(self, a, a_labels, b, b_labels, weights, labels):
+        """
+        Join two small tensors and sum out their other indices in a single pass (einsum),
+        which for small tensors costs less than laying them out as matrices.
+
+        :param a: The first tensor
+        :param a_labels: An integer label (below 52) of each index of the first tensor
+        :param b: The second tensor
+        :param b_labels: An integer label of each index of the second tensor
+        :param weights: The pair of weights of each summed label, by label
+        :param labels: The labels of the indices of the result
+        :return: The resulting tensor, or None if the entries are exact or reduced by a
+                 modulus (whose products of several entries could overflow)
+        """
+        if self._modulus is not None or self._numpy.dtype(self._entry_type).hasobject:
+            return None
+        operands = [a, a_labels, b, b_labels]
+        for label, pair in weights.items():
+            operands += [self._numpy.asarray(pair, dtype=self._entry_type), [label]]
+        return self._numpy.einsum(*operands, labels)
+
+    def is_view_of(self, a, b):
+        """
+        :return: False if the entries of tensor a were certainly copied from tensor b,
+                 rather than viewed in place
+        """
+        return self._numpy.may_share_memory(a, b)
+
+    def count_transposes(self, copied, saved):
+        """
+        Record the bytes of tensors that were copied to transpose them, and the bytes of
+        those whose copy was avoided by the choice of their layout.
+        """
+        with self._transpose_lock:
+            self.transpose_counts["copied"] += copied
+            self.transpose_counts["saved"] += saved
+
+    def transpose(self, a, axes):
+        return self._numpy.transpose(a, axes)
+
+    def reshape(self, a, shape):
+        return self._numpy.reshape(a, shape)
+
+    def matmul(self, a, b):
+        result = self._buffers.take(
+            self._matmul_shape(a, b), self._numpy.result_type(a.dtype, b.dtype)
+        )
+        if self._modulus is None:
+            return self._numpy.matmul(a, b, out=result)
+
+        # Reduce partial products often enough that the int64 sums cannot overflow
+        summed = a.shape[-1]
+        if summed <= self._max_summed:
+            self._numpy.matmul(a, b, out=result)
+            return self._numpy.remainder(result, self._modulus, out=result)
+        result = 0
+        for start in range(0, summed, self._max_summed):
+            end = start + self._max_summed
+            part = self._numpy.matmul(a[..., start:end], b[..., start:end, :])
+            result = (result + part % self._modulus) % self._modulus
+        return result
+
+    def _matmul_shape(self, a, b):
+        """
+        :return: The shape of the product of the provided (batches of) matrices
+        """
+        return self._numpy.broadcast_shapes(a.shape[:-2], b.shape[:-2]) + (
+            a.shape[-2],
+            b.shape[-1],
+        )
+
+    def spill(self, a, directory):
+        """
+        Move the provided tensor into a memory-mapped file in the provided directory.
+
+        The file is unlinked immediately, so its space is released once the returned
+        tensor is no longer used. Tensors of Python objects cannot be spilled.
+
+        :param a: The tensor to spill
+        :param directory: The directory in which to create the file
+        :return: The spilled tensor, or the provided tensor if it cannot be spilled
+        """
+        if a.dtype.hasobject:
+            return a
+
+        import tempfile
+
+        with tempfile.TemporaryFile(dir=directory) as file:
+            result = self._numpy.memmap(file, dtype=a.dtype, mode="w+", shape=a.shape)
+            result[...] = a
+            result.flush()
+        return result
+
+    def is_spilled(self, a):
+        return isinstance(a, self._numpy.memmap)
 
     def contract(self, network, contraction_tree, log):
         try:
-            if self._thread_limit is not None:
-                with self._thread_limiter.threadpool_limits(
-                    limits=self._thread_limit, user_api="blas"
-                ):
-                    return network.identify(contraction_tree, self, log)
-            else:
+            with self.limit_threads():
                 return network.identify(contraction_tree, self, log)
         except MemoryError:
             raise OutOfMemoryError
@@ -42,7 +462,8 @@ class NumpyAPI:
             "float16": self._numpy.float16,
             "uint": self._numpy.uint64,
             "int": self._numpy.int64,
-            "bigint": self._numpy.object,
+            "bigint": object,
+            "exact": self._numpy.int64,  # Used with a modulus
         }
 
         if entry_type in types:
@@ -53,7 +474,366 @@ class NumpyAPI:
     def get_entry_size(self):
         return self._numpy.dtype(self._entry_type).itemsize
 
+    def fingerprint(self):
+        """
+        :return: A value that is equal for two libraries exactly when they compute the
+                 same entries (for use in cache keys)
+        """
+        return (
+            "numpy",
+            self._numpy.dtype(self._entry_type).str,
+            self._modulus,
+            self.semiring.name,
+        )
+
+
+class SparseAPI(NumpyAPI):
+    """
+    A numpy tensor library that stores the results of join tree nodes whose entries are
+    mostly zero as sparse arrays, whose joins and projections take time proportional to
+    the number of nonzero entries (see SparseArray).
+
+    The representation of each result is chosen by its measured density (see compact).
+    Modular arithmetic (see with_modulus) and maximizing semirings are always dense.
+    """
+
+    def __init__(self, entry_type, max_density=1 / 16, min_rank=10, **kwargs):
+        """
+        :param entry_type: The data type of all tensor entries
+        :param max_density: Results with at most this fraction of nonzero entries are
+                            stored sparsely. Sparse results with more than twice this
+                            fraction are stored densely again.
+        :param min_rank: Results of lower rank are always stored densely
+        :param kwargs: The other options of NumpyAPI
+        """
+        super().__init__(entry_type, **kwargs)
+        self._max_density = max_density
+        self._min_rank = min_rank
+
+    def is_sparse(self, a):
+        return isinstance(a, SparseArray)
+
+    def to_dense(self, a):
+        if self.is_sparse(a):
+            return a.to_dense()
+        return a
+
+    def compact(self, a):
+        if self._modulus is not None or self.semiring.maximizes:
+            return a
+        if self.is_sparse(a):
+            if a.density > 2 * self._max_density and len(a.shape) <= 30:
+                return a.to_dense()
+            return a
+        if len(a.shape) < self._min_rank:
+            return a
+        if self._numpy.count_nonzero(a) <= self._max_density * a.size:
+            return SparseArray.from_dense(a)
+        return a
+
+    def stack(self, array, **kwargs):
+        return super().stack([self.to_dense(a) for a in array], **kwargs)
+
+    def tensordot(self, a, b, axes):
+        if self.is_sparse(a):
+            a_axis, b_axis = axes
+            if b_axis == 0 and len(self._numpy.shape(b)) == 1:
+                return a.project([a_axis], [b])
+            a = a.to_dense()
+        return super().tensordot(a, b, axes)
+
+    def project(self, a, axes, weights):
+        if self.is_sparse(a):
+            return a.project(axes, weights)
+        return super().project(a, axes, weights)
+
+    def release(self, a):
+        if not self.is_sparse(a):
+            super().release(a)
+
+    def normalize(self, a):
+        if self.is_sparse(a):
+            if len(a.values) == 0:
+                return a, 0.0
+            values, log_magnitude = super().normalize(a.values)
+            return SparseArray(len(a.shape), a.index, values), log_magnitude
+        return super().normalize(a)
+
+    def ensure_writeable(self, a):
+        if self.is_sparse(a):
+            return a  # Sparse arrays are never modified in place
+        return super().ensure_writeable(a)
+
+    def read_only(self, a):
+        if self.is_sparse(a):
+            return a
+        return super().read_only(a)
+
+    def threshold(self, a):
+        if self.is_sparse(a):
+            return a.threshold()
+        return super().threshold(a)
+
+    def spill(self, a, directory):
+        if self.is_sparse(a):
+            return a
+        return super().spill(a, directory)
+
+    def fingerprint(self):
+        return ("sparse",) + super().fingerprint()[1:]
+
+
+class BlockedAPI(NumpyAPI):
+    """
+    A numpy tensor library that splits each large matrix product into blocks, which are
+    multiplied at once by a pool of threads (numpy releases the GIL while multiplying).
+    BLAS is limited to one thread, so that the pool is the only intra-op parallelism.
+
+    The pool has one thread for each core and is shared by all libraries of the process,
+    so that the libraries of jobs that run at once do not each start their own. Each
+    library multiplies at most thread_limit blocks at once.
+    """
+
+    _pool = None  # The pool of the process, started by the first library
+    _pool_lock = threading.Lock()
+
+    def __init__(self, entry_type, thread_limit=None, min_block_work=2 ** 22, **kwargs):
+        """
+        :param entry_type: The data type of all tensor entries
+        :param thread_limit: The number of threads in the pool (default is one for each
+                             core)
+        :param min_block_work: Products of fewer multiplications are not split
+        :param kwargs: The other options of NumpyAPI
+        """
+        super().__init__(entry_type, thread_limit=thread_limit, **kwargs)
+        import concurrent.futures
+        import os
+
+        with BlockedAPI._pool_lock:
+            if BlockedAPI._pool is None:
+                BlockedAPI._pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+        self._max_blocks = os.cpu_count() if thread_limit is None else thread_limit
+        self._min_block_work = min_block_work
+        self._blocks = self._max_blocks
+
+    @contextlib.contextmanager
+    def limit_threads(self, workers=1):
+        # Each of the workers splits its products between its share of the blocks
+        self._blocks = max(1, self._max_blocks // workers)
+        try:
+            with _BLAS_LIMITS.limit(1):
+                yield
+        finally:
+            self._blocks = self._max_blocks
+
+    def matmul(self, a, b):
+        numpy = self._numpy
+        shape = self._matmul_shape(a, b)
+        if (
+            self._modulus is not None
+            or self._blocks == 1
+            or a.dtype.hasobject
+            or b.dtype.hasobject
+            or int(numpy.prod(shape)) * a.shape[-1] < self._min_block_work
+        ):
+            return super().matmul(a, b)
+
+        result = self._buffers.take(shape, numpy.result_type(a.dtype, b.dtype))
+
+        # Split the largest of the rows, the columns, and the (unbroadcast) batch
+        rows = (a.shape[-2], lambda s: (a[..., s, :], b, result[..., s, :]))
+        columns = (b.shape[-1], lambda s: (a, b[..., s], result[..., s]))
+        batch = (0, None)
+        if len(a.shape) == len(b.shape) > 2 and a.shape[0] == b.shape[0]:
+            batch = (a.shape[0], lambda s: (a[s], b[s], result[s]))
+        size, split = max([rows, columns, batch], key=lambda option: option[0])
+        bounds = sorted(set(numpy.linspace(0, size, self._blocks + 1, dtype=int)))
+
+        def multiply(block):
+            a_block, b_block, result_block = split(slice(*block))
+            numpy.matmul(a_block, b_block, out=result_block)
+
+        list(self._pool.map(multiply, zip(bounds[:-1], bounds[1:])))
+        return result
+
+
+class _SharedTensors:
+    """
+    The read-only tensors shared between calls, by key, of which the least recently used
+    are evicted once they hold more than a budget of memory.
+    """
+
+    def __init__(self, budget):
+        """
+        :param budget: The memory (bytes) that the tensors may hold
+        """
+        self._budget = budget
+        self._tensors = collections.OrderedDict()
+        self.held = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: The tensor shared under the key, or None if there is none
+        """
+        with self._lock:
+            result = self._tensors.get(key)
+            if result is not None:
+                self._tensors.move_to_end(key)
+            return result
+
+    def put(self, key, tensor):
+        """
+        Share the provided (read-only) tensor under the key, if it fits the budget.
+        """
+        if tensor.nbytes > self._budget:
+            return
+        with self._lock:
+            if key in self._tensors:
+                return
+            self._tensors[key] = tensor
+            self.held += tensor.nbytes
+            while self.held > self._budget:
+                _, evicted = self._tensors.popitem(last=False)
+                self.held -= evicted.nbytes
+
+
+class _BufferPool:
+    """
+    Lists of free buffers by data type and size, so that the buffers of released tensors
+    are reused by later tensors of the same size (as the tensors of a join tree mostly
+    are), rather than returned to the allocator and page-faulted in again.
+    """
+
+    def __init__(self, numpy, budget, min_size=2 ** 16):
+        """
+        :param numpy: The numpy module
+        :param budget: The memory (bytes) that free buffers may hold
+        :param min_size: Smaller buffers (bytes) are left to the allocator
+        """
+        self._numpy = numpy
+        self._budget = budget
+        self._min_size = min_size
+        self._free = {}
+        self.held = 0
+        self._taken = weakref.WeakValueDictionary()  # The buffers in use, by id
+        self._lock = threading.Lock()
+        self.counts = {"allocated": 0, "reused": 0, "reused_bytes": 0}
+
+    def take(self, shape, dtype):
+        """
+        :return: An uninitialized tensor of the provided shape and data type
+        """
+        dtype = self._numpy.dtype(dtype)
+        size = 1
+        for length in shape:
+            size *= length
+        if dtype.hasobject or size * dtype.itemsize < self._min_size:
+            return self._numpy.empty(shape, dtype=dtype)
+
+        key = (dtype.str, size)
+        with self._lock:
+            free = self._free.get(key, [])
+            buffer = free.pop() if len(free) > 0 else None
+            if buffer is not None:
+                self.held -= buffer.nbytes
+                self.counts["reused"] += 1
+                self.counts["reused_bytes"] += buffer.nbytes
+            else:
+                self.counts["allocated"] += 1
+        if buffer is None:
+            buffer = self._numpy.empty(size, dtype=dtype)
+        with self._lock:
+            self._taken[id(buffer)] = buffer
+        return buffer.reshape(shape)
+
+    def give(self, a):
+        """
+        Return the buffer of the provided tensor to the pool, if it was taken from the
+        pool and the tensor is writeable (i.e., not shared).
+        """
+        if not isinstance(a, self._numpy.ndarray) or not a.flags.writeable:
+            return
+        buffer = a
+        while isinstance(buffer.base, self._numpy.ndarray):
+            buffer = buffer.base
+        with self._lock:
+            if self._taken.get(id(buffer)) is not buffer:
+                return  # Not from the pool, or already returned
+            del self._taken[id(buffer)]
+            if self.held + buffer.nbytes > self._budget:
+                return
+            self._free.setdefault((buffer.dtype.str, buffer.size), []).append(buffer)
+            self.held += buffer.nbytes
+
+    def drop(self, size):
+        """
+        Drop free buffers, largest first, until they hold the provided memory (bytes)
+        less, or none are left.
+
+        :return: The memory (bytes) of the dropped buffers
+        """
+        dropped = 0
+        with self._lock:
+            for key in sorted(self._free, key=lambda k: k[1], reverse=True):
+                free = self._free[key]
+                while len(free) > 0 and dropped < size:
+                    dropped += free.pop().nbytes
+                if len(free) == 0:
+                    del self._free[key]
+                if dropped >= size:
+                    break
+            self.held -= dropped
+        return dropped
+
+
+class _BlasLimits:
+    """
+    The limit of BLAS threads, which is a single setting of the process. While several
+    limits apply at once (e.g. those of jobs that run at once in a server), the smallest
+    applies, so that no job exceeds its own; once none applies, the original limit is
+    restored. Limits may end in any order, unlike nested threadpoolctl limits.
+    """
+
+    def __init__(self):
+        self._limits = []
+        self._original = None  # The threadpoolctl limiter that restores the original
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def limit(self, threads):
+        """
+        :param threads: The largest number of BLAS threads to use
+        :return: A context manager within which the limit applies
+        """
+        import threadpoolctl
+
+        with self._lock:
+            if len(self._limits) == 0:
+                self._original = threadpoolctl.threadpool_limits(
+                    limits=threads, user_api="blas"
+                )
+            self._limits.append(threads)
+            threadpoolctl.threadpool_limits(limits=min(self._limits), user_api="blas")
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._limits.remove(threads)
+                if len(self._limits) == 0:
+                    self._original.restore_original_limits()
+                    self._original = None
+                else:
+                    threadpoolctl.threadpool_limits(
+                        limits=min(self._limits), user_api="blas"
+                    )
+
+
+_BLAS_LIMITS = _BlasLimits()
+
 
 ALL_APIS = {
     "numpy": NumpyAPI,
+    "sparse": SparseAPI,
+    "blocked": BlockedAPI,
 }
@@ -1,12 +1,30 @@
-from collections import defaultdict
+import fractions
+import numpy
+
+_WHITESPACE = numpy.zeros(256, dtype=bool)
+_WHITESPACE[list(b" \t\n\r\v\f")] = True
+_CLAUSE_CHARACTERS = _WHITESPACE.copy()
+_CLAUSE_CHARACTERS[list(b"-0123456789")] = True
+_CLAUSE_BATCH_LINES = 2 ** 16  # The clause lines tokenized together
 
 
 class Formula:
-    def __init__(self):
-        self._variables = defaultdict(lambda: (1.0, 1.0))  # weights of (-x, x)
-        self._clauses = []
+    def __init__(self, num_variables=0):
+        # Weights of (-x, x) for each variable x; row 0 is unused
+        self._weights = numpy.ones((num_variables + 1, 2), dtype=numpy.float64)
+        self._weighted = numpy.zeros(num_variables + 1, dtype=bool)
+        # The weight of each weighted literal as given (e.g. as decimal text), by
+        # 2 * variable + index, from which exact weights are built when asked for
+        self._exact_weights = {}
+        self._outer = None  # The shown variables of a projected formula, if any
+
+        # The literals of clause i are self._literals[self._offsets[i]:self._offsets[i+1]]
+        self._literals = numpy.zeros(0, dtype=numpy.int64)
+        self._offsets = numpy.zeros(1, dtype=numpy.int64)
+        self._xor = numpy.zeros(0, dtype=bool)  # Whether each clause is an XOR clause
+        self._pending = []  # Clauses added but not yet moved into the arrays
 
-    def add_clause(self, literals):
+    def add_clause(self, literals, xor=False):
         """
         Add a new CNF clause representing the disjunction of the provided literals.
 
@@ -14,37 +32,205 @@ class Formula:
         positive literal) or the negative of a variable id (for the negative literal).
 
         :param literals: An iterable of variable ids and negations of variable ids.
+        :param xor: If true, the clause instead represents the exclusive or of the literals
+        :return: None
+        """
+        self._pending.append((list(literals), xor))
+
+    def add_clauses(self, literals, offsets, xor=None):
+        """
+        Add many new CNF clauses at once.
+
+        :param literals: An array of the literals of all clauses, one clause after another
+        :param offsets: An array of the index in literals at which each clause starts,
+                        followed by the total number of literals
+        :param xor: An array of whether each clause is an XOR clause (default is none)
         :return: None
         """
-        self._clauses.append(list(literals))
+        self._flush()
+        if xor is None:
+            xor = numpy.zeros(len(offsets) - 1, dtype=bool)
+        self._xor = numpy.concatenate([self._xor, numpy.asarray(xor, dtype=bool)])
+        self._literals = numpy.concatenate(
+            [self._literals, numpy.asarray(literals, dtype=numpy.int64)]
+        )
+        self._offsets = numpy.concatenate(
+            [
+                self._offsets[:-1],
+                numpy.asarray(offsets, dtype=numpy.int64) + self._offsets[-1],
+            ]
+        )
 
     def set_weight(self, var_id, neg_weight, pos_weight):
         """
         Set the weight of the variable in the formula.
 
+        Weights may be numbers, Fractions or decimal text, which are kept as given for
+        exact counting (see exact_literal_weight).
+
         :param var_id: Variable to set weight of
         :param neg_weight: Multiplicative weight on an assignment when variable is false
         :param pos_weight: Multiplicative weight on an assignment when variable is true
         :return: None
         """
-        self._variables[var_id] = (neg_weight, pos_weight)
+        self._reserve(var_id)
+        self._weights[var_id] = (float(neg_weight), float(pos_weight))
+        self._weighted[var_id] = True
+        self._exact_weights[2 * var_id] = neg_weight
+        self._exact_weights[2 * var_id + 1] = pos_weight
+
+    def set_literal_weight(self, lit, weight):
+        """
+        Set the weight of a single literal in the formula.
+
+        :param lit: DIMACS literal to set the weight of
+        :param weight: Multiplicative weight on an assignment that satisfies the literal
+                       (as in set_weight)
+        :return: None
+        """
+        self._reserve(abs(lit))
+        self._weights[abs(lit), 1 if lit > 0 else 0] = float(weight)
+        self._weighted[abs(lit)] = True
+        self._exact_weights[2 * abs(lit) + (1 if lit > 0 else 0)] = weight
+
+    def set_outer_variables(self, variables):
+        """
+        Make the formula projected onto the provided (outer) variables, in addition to
+        any outer variables set before (e.g. by earlier show lines).
+
+        All other variables are inner variables, which are projected existentially:
+        each assignment of the outer variables counts once (with its weight) if some
+        assignment of the inner variables extends it to satisfy the formula.
+
+        :param variables: An iterable of variable ids
+        :return: None
+        """
+        if self._outer is None:
+            self._outer = set()
+        self._outer.update(variables)
+
+    @property
+    def outer_variables(self):
+        """
+        The sorted outer variables of a projected formula, or None if the formula is
+        not projected.
+        """
+        return None if self._outer is None else sorted(self._outer)
+
+    def is_inner(self, var):
+        """
+        Returns true if the formula is projected and the variable is not an outer variable.
+        """
+        return self._outer is not None and var not in self._outer
 
     def clause(self, clause_id):
-        return self._clauses[clause_id]
+        self._flush()
+        start, end = self._offsets[clause_id], self._offsets[clause_id + 1]
+        return self._literals[start:end].tolist()
+
+    def is_xor(self, clause_id):
+        """
+        Returns true if the clause is an XOR clause, i.e. the exclusive or of its literals.
+        """
+        self._flush()
+        return bool(self._xor[clause_id])
 
     @property
     def clauses(self):
-        return list(self._clauses)
+        self._flush()
+        return [
+            clause.tolist()
+            for clause in numpy.split(self._literals, self._offsets[1:-1])
+        ]
+
+    @property
+    def num_clauses(self):
+        return len(self._offsets) - 1 + len(self._pending)
 
     @property
     def variables(self):
-        return list(self._variables.keys())
+        return numpy.flatnonzero(self._weighted).tolist()
 
     def literal_weight(self, lit):
         """
         Returns the multiplicative weight of the provided DIMACS literal.
         """
-        return self._variables[abs(lit)][1 if lit > 0 else 0]
+        if abs(lit) >= len(self._weights):
+            return 1.0
+        return float(self._weights[abs(lit), 1 if lit > 0 else 0])
+
+    def exact_literal_weight(self, lit):
+        """
+        Returns the weight of the provided DIMACS literal as a Fraction, which is exact
+        for weights parsed from decimal text (e.g. 0.3 is 3/10).
+        """
+        return fractions.Fraction(
+            self._exact_weights.get(2 * abs(lit) + (1 if lit > 0 else 0), 1)
+        )
+
+    def parse_weight_matrix(self, file):
+        """
+        Parse a matrix of weights, with one row for each of a batch of weighted counts.
+
+        Each row lists the positive and then the negative literal weight of each variable
+        in turn, as in MiniC2D weights. Variables after the end of a row keep their weights
+        in this formula.
+
+        :param file: A handler to the file to read
+        :return: An array whose entry [var, 0 or 1, row] is the weight of the negative or
+                 positive literal of var in that row
+        """
+        rows = [
+            numpy.array(line.split(), dtype=numpy.float64)
+            for line in file.read().splitlines()
+            if len(line.strip()) > 0 and not line.startswith("c")
+        ]
+        if len(rows) == 0:
+            raise ValueError("No rows in weight matrix")
+
+        # Ensure that every variable of the rows and of the clauses has weights
+        self._flush()
+        self._reserve(max(len(row) // 2 for row in rows))
+        if len(self._literals) > 0:
+            self._reserve(int(numpy.abs(self._literals).max()))
+
+        result = numpy.repeat(self._weights[:, :, None], len(rows), axis=2)
+        for i, row in enumerate(rows):
+            num_variables = len(row) // 2
+            result[1 : num_variables + 1, 1, i] = row[0 : 2 * num_variables : 2]
+            result[1 : num_variables + 1, 0, i] = row[1 : 2 * num_variables : 2]
+        return result
+
+    def _reserve(self, var_id):
+        """
+        Ensure that the weight arrays have a row for the provided variable.
+        """
+        if var_id < len(self._weights):
+            return
+        size = max(var_id + 1, 2 * len(self._weights))
+        weights = numpy.ones((size, 2), dtype=numpy.float64)
+        weights[: len(self._weights)] = self._weights
+        weighted = numpy.zeros(size, dtype=bool)
+        weighted[: len(self._weighted)] = self._weighted
+        self._weights, self._weighted = weights, weighted
+
+    def _flush(self):
+        """
+        Move all pending clauses into the literal and offset arrays.
+        """
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, []
+        lengths = numpy.array([len(clause) for clause, _ in pending], dtype=numpy.int64)
+        self.add_clauses(
+            numpy.fromiter(
+                (lit for clause, _ in pending for lit in clause),
+                dtype=numpy.int64,
+                count=int(lengths.sum()),
+            ),
+            numpy.concatenate([[0], numpy.cumsum(lengths)]),
+            [xor for _, xor in pending],
+        )
 
     @staticmethod
     def parse_DIMACS(file):
@@ -58,46 +244,102 @@ class Formula:
 
         If [prob] is -1, the variable is unweighted
 
+        The file may also contain a line of the form
+        c p show [var ids] 0
+        in which case the formula is projected onto the variables of all such lines.
+
+        Clause lines that start with "x" are XOR clauses, as in XOR-CNF (.xcnf) files.
+
+        Each clause line is read as a single clause. The file is read line by line, and
+        the literals of each batch of consecutive clause lines are tokenized together in
+        bulk, so that only one batch of clause text is held at a time.
+
         :param file: A handler to the file to read
         :return: the resulting formula
         """
         result = Formula()
+        literals, lengths, xor = [], [], []  # The clauses of each tokenized batch
+        batch = []  # Consecutive clause lines of the same kind (XOR or not)
+        batch_xor = False
 
-        for line in file:
-            if line.startswith("c weights"):  # MiniC2D weights
-                weights = line.split(" ")[2:]
-                for i in range(len(weights) // 2):
-                    result.set_weight(
-                        i + 1, float(weights[2 * i + 1]), float(weights[2 * i])
-                    )
-            elif line.startswith("c p weight"):  # MC-2021 weights
-                words = line.split()
-                lit = int(words[3])
-                weight = float(words[4])
+        def tokenize_batch():
+            if len(batch) > 0:
+                batch_literals, batch_lengths = _tokenize_clause_lines(batch)
+                literals.append(batch_literals)
+                lengths.append(batch_lengths)
+                xor.append(numpy.full(len(batch_lengths), batch_xor, dtype=bool))
+                batch.clear()
 
-                var = abs(lit)
-                (neg_weight, pos_weight) = result._variables[var]
-
-                if lit > 0:
-                    result._variables[var] = (neg_weight, weight)
-                else:
-                    result._variables[var] = (weight, pos_weight)
-            elif len(line) == 0 or line[0] == "c":
+        for line in file:
+            line = line.rstrip("\r\n")
+            if len(line) == 0:
                 continue
+            elif line[0] == "c":
+                if line.startswith("c weights"):  # MiniC2D weights
+                    weights = line.split(" ")[2:]
+                    for i in range(len(weights) // 2):
+                        result.set_weight(i + 1, weights[2 * i + 1], weights[2 * i])
+                elif line.startswith("c p weight"):  # MC-2021 weights
+                    words = line.split()
+                    result.set_literal_weight(int(words[3]), words[4])
+                elif line.startswith("c p show"):  # MC-2021 projection
+                    words = line.split()
+                    result.set_outer_variables(
+                        int(word) for word in words[3:] if word != "0"
+                    )
             elif line[0] == "p":
                 num_vars = int(line.split()[2])
+                result._reserve(num_vars)
             elif line[0] == "w":  # Cachet weights
                 args = line.split()
-                if float(args[2]) == -1:
+                prob = fractions.Fraction(args[2])
+                if prob == -1:
                     result.set_weight(int(args[1]), 1, 1)
                 else:
-                    prob = float(args[2])
                     result.set_weight(int(args[1]), 1 - prob, prob)
             else:
-                args = line.split()
-                literals = [int(lit) for lit in args if lit != "0"]
-                if len(literals) == 0:
-                    continue
-                result.add_clause(literals)
+                is_xor = line[0] == "x"
+                if is_xor != batch_xor or len(batch) >= _CLAUSE_BATCH_LINES:
+                    tokenize_batch()
+                    batch_xor = is_xor
+                batch.append(line[1:] if is_xor else line)
+        tokenize_batch()
 
+        if len(lengths) == 0:
+            return result
+        lengths = numpy.concatenate(lengths)
+        result.add_clauses(
+            numpy.concatenate(literals),
+            numpy.concatenate([[0], numpy.cumsum(lengths)]),
+            numpy.concatenate(xor),
+        )
         return result
+
+
+def _tokenize_clause_lines(lines):
+    """
+    Tokenize the literals of the provided clause lines in bulk, reading each line as a
+    single clause (terminated by its 0, if any).
+
+    :return: An array of the literals of all nonempty clauses, and an array of the
+             number of literals of each of these clauses
+    """
+    # Terminate every line with a 0, so that each line is read as a clause
+    text = " 0\n".join(lines) + " 0"
+    tokens = numpy.fromstring(text, dtype=numpy.int64, sep=" ")
+
+    # Check that every character was part of an integer
+    data = numpy.frombuffer(text.encode("ascii", errors="replace"), dtype=numpy.uint8)
+    del text
+    if not _CLAUSE_CHARACTERS[data].all():
+        raise ValueError("Unexpected characters in clause lines")
+    is_space = _WHITESPACE[data]
+    token_starts = numpy.count_nonzero(is_space[:-1] & ~is_space[1:])
+    num_tokens = token_starts + (0 if is_space[0] else 1)
+    if num_tokens != len(tokens):
+        raise ValueError("Unable to parse clause lines")
+
+    # Split the literals at each 0, skipping empty clauses
+    ends = numpy.flatnonzero(tokens == 0)
+    lengths = numpy.diff(numpy.concatenate([[-1], ends])) - 1
+    return tokens[tokens != 0], lengths[lengths > 0]
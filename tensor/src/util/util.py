@@ -19,27 +19,42 @@ class TimeoutTimer:
         self._initial_timeout = initial_timeout
         self._start_time = 0
         self._end_time = 0
+        self._wakeups = []
+        self._triggered = False
 
     def __enter__(self):
         """
         Start the timer.
         :return: This timer
         """
-
-        def handler(signum, frame):
-            raise TimeoutError()
-
-        try:
-            signal.signal(signal.SIGALRM, handler)
-
-            if self._initial_timeout > 0:
-                signal.setitimer(signal.ITIMER_REAL, self._initial_timeout)
-        except AttributeError:
-            log("Unable to use signals; timeout will be less effective")
+        self._install()
+        if self._initial_timeout > 0:
+            self._set_alarm(self._initial_timeout)
         self._start_time = time.time()
         self._end_time = self._start_time + self._initial_timeout
         return self
 
+    def add_wakeup(self, wakeup):
+        """
+        Register a function to call when the timer triggers, to wake a wait
+        that the TimeoutError cannot interrupt. Waits are interrupted by signals,
+        so this timer never calls them.
+
+        :param wakeup: The function to call
+        :return: None
+        """
+        self._wakeups.append(wakeup)
+
+    def check(self):
+        """
+        Raise a TimeoutError if the timer has triggered. Threads other than the one that
+        started the timer (which signals do not interrupt) should call this regularly.
+
+        :return: None
+        """
+        if self._triggered:
+            raise TimeoutError()
+
     def recap_timeout(self, new_timeout):
         """
         Set the new timeout of this Timer, measured from the start of the timer,
@@ -58,11 +73,8 @@ class TimeoutTimer:
             self._end_time = self._start_time + new_timeout
             raise TimeoutError()
         else:
-            try:
-                if signal.getitimer(signal.ITIMER_REAL)[0] > new_time_remaining:
-                    signal.setitimer(signal.ITIMER_REAL, new_time_remaining)
-            except AttributeError:
-                pass
+            if self._get_alarm() > new_time_remaining:
+                self._set_alarm(new_time_remaining)
             self._end_time = self._start_time + new_timeout
 
     def reset_timeout(self, new_timeout):
@@ -83,10 +95,7 @@ class TimeoutTimer:
             self._end_time = self._start_time + new_timeout
             raise TimeoutError()
         else:
-            try:
-                signal.setitimer(signal.ITIMER_REAL, new_time_remaining)
-            except AttributeError:
-                pass
+            self._set_alarm(new_time_remaining)
             self._end_time = self._start_time + new_timeout
 
     def __exit__(self, exit_type, value, traceback):
@@ -101,15 +110,94 @@ class TimeoutTimer:
         Cancel the timer.
         :return: None
         """
-        try:
-            signal.setitimer(signal.ITIMER_REAL, 0)
-        except AttributeError:
-            pass
+        self._set_alarm(0)
         self._end_time = self._start_time
 
     def expired(self):
         return time.time() > self._end_time
 
+    def _install(self):
+        """
+        Prepare to trigger the TimeoutError.
+        """
+
+        def handler(signum, frame):
+            self._triggered = True
+            raise TimeoutError()
+
+        try:
+            signal.signal(signal.SIGALRM, handler)
+        except AttributeError:
+            log("Unable to use signals; timeout will be less effective")
+
+    def _get_alarm(self):
+        """
+        :return: The time until the TimeoutError is triggered (s), or 0 if it is not set
+        """
+        try:
+            return signal.getitimer(signal.ITIMER_REAL)[0]
+        except AttributeError:
+            return 0
+
+    def _set_alarm(self, time_remaining):
+        """
+        Trigger the TimeoutError after the provided time (s), or never if 0.
+        """
+        if time_remaining > 0:
+            self._triggered = False
+        try:
+            signal.setitimer(signal.ITIMER_REAL, time_remaining)
+        except AttributeError:
+            pass
+
+
+class ThreadTimeoutTimer(TimeoutTimer):
+    """
+    A TimeoutTimer without signals, so that many timers may run at once in different
+    threads.
+
+    The TimeoutError is raised cooperatively: only calls to check (e.g. between node
+    contractions) raise it, so it never interrupts a thread within native code or
+    cleanup code. Functions registered by add_wakeup are called to wake waiting threads,
+    so that they can check the timer.
+    """
+
+    def __init__(self, initial_timeout):
+        TimeoutTimer.__init__(self, initial_timeout)
+        self._alarm = None
+        self._alarm_time = 0
+        self._lock = threading.Lock()
+
+    def _install(self):
+        pass
+
+    def _get_alarm(self):
+        with self._lock:
+            if self._alarm is None:
+                return 0
+            return max(self._alarm_time - time.time(), 0)
+
+    def _set_alarm(self, time_remaining):
+        with self._lock:
+            if self._alarm is not None:
+                self._alarm.cancel()
+                self._alarm = None
+            if time_remaining > 0:
+                self._triggered = False
+                self._alarm = threading.Timer(time_remaining, self._trigger)
+                self._alarm.daemon = True
+                self._alarm_time = time.time() + time_remaining
+                self._alarm.start()
+
+    def _trigger(self):
+        with self._lock:
+            if self._alarm is not threading.current_thread():
+                return  # The alarm was cancelled or replaced
+            self._alarm = None
+            self._triggered = True
+        for wakeup in self._wakeups:
+            wakeup()
+
 
 class Stopwatch:
     """
@@ -178,8 +266,18 @@ class KeyValueOutput(click.File):
             result = StderrWrapper()
         else:
             result = click.File.convert(self, value, param, ctx)
-        result.output_pair = lambda key, val: result.write(key + ": " + str(val) + "\n")
-        return result
+        return KeyValueOutput.wrap(result)
+
+    @staticmethod
+    def wrap(stream):
+        """
+        Add the output_pair method to the provided stream.
+
+        :param stream: An object with a write method
+        :return: The stream
+        """
+        stream.output_pair = lambda key, val: stream.write(key + ": " + str(val) + "\n")
+        return stream
 
 
 class TypedChoice(click.Choice):
@@ -365,6 +463,52 @@ def kill_on_crash(sig=None):
     return do
 
 
+def map_parallel(function, items, workers):
+    """
+    Apply the function to every item, using up to the provided number of threads.
+
+    The threads are daemons, so calls abandoned after an error (e.g., a timeout
+    in the main thread) do not delay the exit of the process.
+
+    :param function: The function to apply
+    :param items: The items to apply the function to
+    :param workers: The number of threads to use
+    :return: The list of results, in the order of the items
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    tasks = queue.Queue()
+    for i in range(len(items)):
+        tasks.put(i)
+    finished = queue.Queue()  # Receives None for each success, or the error raised
+
+    def work():
+        while True:
+            try:
+                i = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[i] = function(items[i])
+                finished.put(None)
+            except BaseException as e:
+                finished.put(e)
+
+    for _ in range(min(workers, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    for _ in items:
+        error = finished.get()
+        if error is not None:
+            raise error
+    return results
+
+
 class BufferedStream:
     """
     Buffer the output of the stream through a queue on a separate thread.
@@ -376,13 +520,14 @@ class BufferedStream:
         self.__stream = stream
         self.__timer = timer
         self.__queue = queue.Queue()
-        self.__finished = False
 
         def enqueue_output():
-            for line in self.__stream:
-                self.__queue.put(line)
-            self.__stream.close()
-            self.__finished = True
+            try:
+                for line in self.__stream:
+                    self.__queue.put(line)
+                self.__stream.close()
+            finally:
+                self.__queue.put(None)  # Wake the reader at the end of the stream
 
         self.__thread = threading.Thread(target=enqueue_output)
         self.__thread.daemon = True
@@ -397,7 +542,13 @@ class BufferedStream:
                 if self.__timer is not None and self.__timer.expired():
                     # If the timer does not successfully go off (i.e., Windows), trigger it here
                     raise TimeoutError()
-                return self.__queue.get(block=True, timeout=1)
+                # Only wake periodically if the timer must be checked here
+                line = self.__queue.get(
+                    block=True, timeout=1 if self.__timer is not None else None
+                )
             except queue.Empty:
-                if self.__finished:
-                    raise StopIteration
+                continue
+            if line is None:
+                self.__queue.put(None)  # Later calls also stop
+                raise StopIteration
+            return line
@@ -0,0 +1,454 @@
+import fractions
+import itertools
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy
+
+EXECUTE = os.path.join(os.path.dirname(__file__), "..", "src", "execute.py")
+SERVER = os.path.join(os.path.dirname(__file__), "..", "src", "server.py")
+CLIENT = os.path.join(os.path.dirname(__file__), "..", "src", "client.py")
+EXAMPLES = os.path.join(os.path.dirname(__file__), "..", "..", "examples")
+
+
+def random_formula(seed, num_variables=6, num_clauses=7):
+    """
+    :return: The clauses of a random CNF formula, and distinct weights of (-x, x) for
+             each variable x
+    """
+    rand = random.Random(seed)
+    clauses = []
+    for _ in range(num_clauses):
+        size = rand.randint(1, 3)
+        variables = rand.sample(range(1, num_variables + 1), size)
+        clauses.append([var if rand.random() < 0.5 else -var for var in variables])
+    for var in range(1, num_variables + 1):
+        # Every variable appears, so that its weights are part of the count
+        if not any(abs(lit) == var for clause in clauses for lit in clause):
+            rand.choice(clauses).append(var if rand.random() < 0.5 else -var)
+    weights = {
+        var: (round(rand.uniform(0.1, 0.45), 3), round(rand.uniform(0.55, 0.9), 3))
+        for var in range(1, num_variables + 1)
+    }
+    return clauses, weights
+
+
+def wide_formula(seed, num_variables):
+    """
+    :return: A random formula (as random_formula) with two more clauses that together
+             contain all variables, so that the node of variable 1 joins all of them
+    """
+    clauses, weights = random_formula(seed, num_variables)
+    half = num_variables // 2
+    clauses.append([-1] + list(range(2, half + 1)))
+    clauses.append([1] + list(range(half + 1, num_variables + 1)))
+    return clauses, weights
+
+
+def weighted_count(clauses, weights, num_variables, xor_clauses=()):
+    """
+    :param xor_clauses: The indices of the clauses that are XOR clauses
+    :return: The sum of the weights of all satisfying assignments, over all assignments
+             at once
+    """
+    index = numpy.arange(2 ** num_variables)
+    values = [None] + [(index >> var) & 1 == 1 for var in range(num_variables)]
+    satisfied = numpy.ones(len(index), dtype=bool)
+    for i, clause in enumerate(clauses):
+        literals = [values[lit] if lit > 0 else ~values[-lit] for lit in clause]
+        if i in xor_clauses:
+            satisfied &= numpy.logical_xor.reduce(literals)
+        else:
+            satisfied &= numpy.logical_or.reduce(literals)
+    result = satisfied.astype(numpy.float64)
+    for var, (neg_weight, pos_weight) in weights.items():
+        result *= numpy.where(values[var], pos_weight, neg_weight)
+    return result.sum()
+
+
+def assignment_weight(clauses, weights, assignment):
+    """
+    :return: The weight of the assignment (a dict of the value of each variable),
+             or 0 if it falsifies a clause
+    """
+    for clause in clauses:
+        if not any((lit > 0) == (assignment[abs(lit)] == 1) for lit in clause):
+            return 0
+    result = 1
+    for var, value in assignment.items():
+        result *= weights[var][value]
+    return result
+
+
+def assignments(num_variables):
+    for values in itertools.product([0, 1], repeat=num_variables):
+        yield dict(zip(range(1, num_variables + 1), values))
+
+
+def execute(clauses, weights, num_variables, *options, xor_clauses=()):
+    """
+    Execute a join tree of the formula (with one internal node for each variable).
+
+    :param xor_clauses: The indices of the clauses that are XOR clauses
+    :return: The output pairs of the executor
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        files = write_formula(directory, clauses, weights, num_variables, xor_clauses)
+        return run(*files, *options)
+
+
+def write_formula(directory, clauses, weights, num_variables, xor_clauses=()):
+    """
+    Write the formula and a join tree of it (with one internal node for each variable).
+
+    :param directory: The directory to write the files to
+    :param xor_clauses: The indices of the clauses that are XOR clauses
+    :return: The formula file and the join tree file
+    """
+    lines = ["p cnf {0} {1}".format(num_variables, len(clauses))]
+    for var, (neg_weight, pos_weight) in weights.items():
+        lines.append("c p weight {0} {1} 0".format(var, pos_weight))
+        lines.append("c p weight {0} {1} 0".format(-var, neg_weight))
+    lines += [
+        ("x" if i in xor_clauses else "") + " ".join(map(str, clause)) + " 0"
+        for i, clause in enumerate(clauses)
+    ]
+
+    # Project out each variable at the first node where it no longer appears above
+    tree = []
+    roots = {i + 1: {abs(lit) for lit in clause} for i, clause in enumerate(clauses)}
+    for var in range(1, num_variables + 1):
+        children = [node for node, variables in roots.items() if var in variables]
+        if len(children) == 0:
+            continue
+        node = len(clauses) + len(tree) + 1
+        tree.append("{0} {1} e {2}".format(node, " ".join(map(str, children)), var))
+        roots[node] = set().union(*[roots.pop(child) for child in children]) - {var}
+    node = len(clauses) + len(tree) + 1
+    tree.append("{0} {1} e".format(node, " ".join(map(str, roots))))
+    tree = ["p jt {0} {1} {2}".format(num_variables, len(clauses), node)] + tree
+
+    formula_file = os.path.join(directory, "formula.cnf")
+    with open(formula_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    tree_file = os.path.join(directory, "formula.jt")
+    with open(tree_file, "w") as f:
+        f.write("\n".join(tree) + "\n=\n")
+    return formula_file, tree_file
+
+
+def run(formula_file, tree_file, *options, program=(EXECUTE,)):
+    """
+    :param program: The script to run and its first arguments (default is the executor)
+    :return: The output pairs of the executor on the provided files
+    """
+    result = subprocess.run(
+        [sys.executable, *program, "--formula", formula_file, "--join_tree", tree_file]
+        + list(options),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return dict(re.findall(r"^(.*?): (.*)$", result.stdout, re.M))
+
+
+class TestExecute(unittest.TestCase):
+    def test_count(self):
+        for seed in range(5):
+            clauses, weights = random_formula(seed)
+            output = execute(clauses, weights, 6)
+            expected = sum(
+                assignment_weight(clauses, weights, assignment)
+                for assignment in assignments(6)
+            )
+            self.assertAlmostEqual(float(output["Count"]), expected)
+
+    def test_exact(self):
+        for seed in range(3):
+            clauses, weights = random_formula(seed)
+            output = execute(clauses, weights, 6, "--entry_type=exact")
+            # The weights are exact as written in the formula (e.g. 0.3 is 3/10)
+            exact_weights = {
+                var: tuple(fractions.Fraction(str(weight)) for weight in pair)
+                for var, pair in weights.items()
+            }
+            expected = sum(
+                assignment_weight(clauses, exact_weights, assignment)
+                for assignment in assignments(6)
+            )
+            self.assertEqual(fractions.Fraction(output["Count"]), expected)
+
+    def test_projected(self):
+        # The count of the README example, as output by DMC
+        phi = os.path.join(EXAMPLES, "phi.cnf")
+        tree_file = os.path.join(EXAMPLES, "phi.jt")
+        self.assertAlmostEqual(float(run(phi, tree_file)["Count"]), 0.4)
+
+        # The outer variables of all show lines count
+        with open(phi) as f:
+            text = f.read().replace("c p show 1 3 5 0", "c p show 1 0\nc p show 3 5 0")
+        with tempfile.TemporaryDirectory() as directory:
+            formula_file = os.path.join(directory, "phi.cnf")
+            with open(formula_file, "w") as f:
+                f.write(text)
+            output = run(formula_file, tree_file)
+        self.assertAlmostEqual(float(output["Count"]), 0.4)
+
+    def test_marginals(self):
+        for seed in range(5):
+            clauses, weights = random_formula(seed)
+            output = execute(clauses, weights, 6, "--marginals")
+            count = sum(
+                assignment_weight(clauses, weights, assignment)
+                for assignment in assignments(6)
+            )
+            for var in range(1, 7):
+                expected = sum(
+                    assignment_weight(clauses, weights, assignment)
+                    for assignment in assignments(6)
+                    if assignment[var] == 1
+                )
+                self.assertAlmostEqual(
+                    float(output["Marginal " + str(var)]), expected / count
+                )
+
+    def test_marginals_unit_clause(self):
+        weights = {1: (0.7, 0.3), 2: (0.2, 0.8)}
+        output = execute([[1], [1, 2]], weights, 2, "--marginals")
+        self.assertAlmostEqual(float(output["Marginal 1"]), 1.0)
+        self.assertAlmostEqual(float(output["Marginal 2"]), 0.8)
+
+    def test_sparse(self):
+        # Store every result sparsely, regardless of its rank and density
+        options = [
+            "--tensor_library=sparse",
+            "--sparse_density=1",
+            "--sparse_min_rank=0",
+        ]
+        for seed in range(5):
+            clauses, weights = random_formula(seed)
+            output = execute(clauses, weights, 6, "--marginals", *options)
+            count = sum(
+                assignment_weight(clauses, weights, assignment)
+                for assignment in assignments(6)
+            )
+            self.assertAlmostEqual(float(output["Count"]), count)
+            for var in range(1, 7):
+                expected = sum(
+                    assignment_weight(clauses, weights, assignment)
+                    for assignment in assignments(6)
+                    if assignment[var] == 1
+                )
+                self.assertAlmostEqual(
+                    float(output["Marginal " + str(var)]), expected / count
+                )
+
+    def test_slicing(self):
+        for seed in range(5):
+            clauses, weights = random_formula(seed)
+            output = execute(
+                clauses, weights, 6, "--max_width=2", "--max_sliced=4", "--marginals"
+            )
+            self.assertNotEqual(output["Sliced Variables"], "")
+            count = weighted_count(clauses, weights, 6)
+            self.assertAlmostEqual(float(output["Count"]), count)
+            for var in range(1, 7):
+                expected = sum(
+                    assignment_weight(clauses, weights, assignment)
+                    for assignment in assignments(6)
+                    if assignment[var] == 1
+                )
+                self.assertAlmostEqual(
+                    float(output["Marginal " + str(var)]), expected / count
+                )
+
+    def test_spilling(self):
+        # The node of variable 1 has a result of 2 MB, which is spilled
+        for seed in range(2):
+            clauses, weights = wide_formula(seed, 19)
+            with tempfile.TemporaryDirectory() as directory:
+                output = execute(
+                    clauses,
+                    weights,
+                    19,
+                    "--spill_dir",
+                    directory,
+                    "--spill_budget=0",
+                )
+            self.assertGreater(int(output["Spilled Bytes"]), 0)
+            self.assertAlmostEqual(
+                float(output["Count"]), weighted_count(clauses, weights, 19)
+            )
+
+    def test_workers(self):
+        for seed in range(5):
+            clauses, weights = random_formula(seed, 10, 12)
+            output = execute(clauses, weights, 10, "--workers=2", "--thread_limit=2")
+            self.assertAlmostEqual(
+                float(output["Count"]), weighted_count(clauses, weights, 10)
+            )
+
+    def test_hadamard(self):
+        for seed in range(5):
+            rand = random.Random(seed)
+            _, weights = random_formula(seed, 10)
+            clauses = [
+                [var if rand.random() < 0.5 else -var for var in variables]
+                for variables in (
+                    rand.sample(range(1, 11), rand.randint(5, 10)) for _ in range(3)
+                )
+            ]
+            # One ordinary clause, with every variable that no XOR clause contains
+            variables = {abs(lit) for clause in clauses for lit in clause}
+            missing = [var for var in range(1, 11) if var not in variables]
+            clauses.append(missing + [rand.choice([-1, 1]) * rand.randint(1, 10)])
+            output = execute(clauses, weights, 10, "--hadamard", xor_clauses={0, 1, 2})
+            self.assertAlmostEqual(
+                float(output["Count"]),
+                weighted_count(clauses, weights, 10, xor_clauses={0, 1, 2}),
+            )
+
+    def test_blocked(self):
+        # Split every product, including those of the node of variable 1
+        options = ["--tensor_library=blocked", "--thread_limit=2", "--min_block_work=1"]
+        for seed in range(3):
+            clauses, weights = wide_formula(seed, 14)
+            output = execute(clauses, weights, 14, *options)
+            self.assertAlmostEqual(
+                float(output["Count"]), weighted_count(clauses, weights, 14)
+            )
+
+    def test_rescale(self):
+        for seed in range(5):
+            clauses, weights = random_formula(seed)
+            expected = weighted_count(clauses, weights, 6)
+            output = execute(clauses, weights, 6, "--rescale")
+            self.assertAlmostEqual(float(output["Count"]), expected)
+            self.assertAlmostEqual(float(output["Log10 Count"]), math.log10(expected))
+
+            output = execute(clauses, weights, 6, "--rescale", "--entry_type=float32")
+            self.assertAlmostEqual(float(output["Count"]), expected, places=5)
+
+    def test_weight_matrix(self):
+        for seed in range(3):
+            clauses, weights = random_formula(seed)
+            rand = random.Random(seed)
+            rows = [
+                {
+                    var: (
+                        round(rand.uniform(0.1, 1), 3),
+                        round(rand.uniform(0.1, 1), 3),
+                    )
+                    for var in range(1, 7)
+                }
+                for _ in range(3)
+            ]
+            with tempfile.TemporaryDirectory() as directory:
+                # Rows list the positive and then the negative weight of each variable
+                matrix_file = os.path.join(directory, "weights.txt")
+                with open(matrix_file, "w") as f:
+                    for row in rows:
+                        f.write(
+                            " ".join(
+                                "{0} {1}".format(row[var][1], row[var][0])
+                                for var in range(1, 7)
+                            )
+                            + "\n"
+                        )
+                output_file = os.path.join(directory, "output.txt")
+                execute(
+                    clauses,
+                    weights,
+                    6,
+                    "--weight_matrix",
+                    matrix_file,
+                    "--output",
+                    output_file,
+                )
+                with open(output_file) as f:
+                    counts = re.findall(r"^Count: (.*)$", f.read(), re.M)
+            self.assertEqual(len(counts), len(rows))
+            for count, row in zip(counts, rows):
+                self.assertAlmostEqual(float(count), weighted_count(clauses, row, 6))
+
+    def test_server(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, "server.sock")
+            server = subprocess.Popen(
+                [sys.executable, SERVER, "--socket", socket_path],
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                deadline = time.time() + 30
+                while not os.path.exists(socket_path) and time.time() < deadline:
+                    time.sleep(0.05)
+
+                clauses, weights = random_formula(0)
+                files = write_formula(directory, clauses, weights, 6)
+                output = run(*files, program=(CLIENT, socket_path))
+                expected = weighted_count(clauses, weights, 6)
+                self.assertAlmostEqual(float(output["Count"]), expected)
+
+                # The same formula is counted again from the cache
+                output = run(*files, program=(CLIENT, socket_path))
+                self.assertGreater(int(output["Cache Hits"]), 0)
+                self.assertAlmostEqual(float(output["Count"]), expected)
+
+                # A changed weight is not counted from the stale results
+                weights[6] = (weights[6][1], weights[6][0])
+                files = write_formula(directory, clauses, weights, 6)
+                output = run(*files, program=(CLIENT, socket_path))
+                self.assertAlmostEqual(
+                    float(output["Count"]), weighted_count(clauses, weights, 6)
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+    def test_buffer_budget(self):
+        # Each slice of the node of variable 1 takes buffers of the same sizes
+        options = ["--max_width=16", "--max_sliced=4"]
+        for seed in range(2):
+            clauses, weights = wide_formula(seed, 19)
+            expected = weighted_count(clauses, weights, 19)
+            output = execute(clauses, weights, 19, "--buffer_budget=1", *options)
+            self.assertGreater(int(output["Reused Buffers"]), 0)
+            self.assertAlmostEqual(float(output["Count"]), expected)
+
+            output = execute(clauses, weights, 19, "--buffer_budget=0", *options)
+            self.assertEqual(int(output["Reused Buffers"]), 0)
+            self.assertAlmostEqual(float(output["Count"]), expected)
+
+    def test_max_product(self):
+        for seed in range(5):
+            clauses, weights = random_formula(seed)
+            output = execute(clauses, weights, 6, "--semiring=max-product")
+            expected = max(
+                assignment_weight(clauses, weights, assignment)
+                for assignment in assignments(6)
+            )
+            self.assertAlmostEqual(float(output["Count"]), expected)
+
+            # The v line must be an assignment of maximum weight
+            self.assertEqual(len(output["v"]), 6)
+            assignment = {var + 1: int(value) for var, value in enumerate(output["v"])}
+            self.assertAlmostEqual(
+                assignment_weight(clauses, weights, assignment), expected
+            )
+
+    def test_max_product_unit_clause(self):
+        weights = {1: (0.7, 0.3), 2: (1, 1)}
+        output = execute([[1], [1, 2]], weights, 2, "--semiring=max-product")
+        self.assertAlmostEqual(float(output["Count"]), 0.3)
+        self.assertIn(output["v"], ("10", "11"))
+
+
+if __name__ == "__main__":
+    unittest.main()